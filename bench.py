@@ -0,0 +1,403 @@
+#!/usr/bin/env python2
+
+"""
+Benchmarks the solvers over the shipped puzzle files.
+
+Each puzzle file is a difficulty tier.  Larger corpora for each tier are
+generated from the file by random symmetry transforms (relabelling
+values, swapping bands, stacks, rows and columns within them, and
+transposing), which keep the difficulty the same.
+
+For each solver and tier, reports puzzles/sec, the latency distribution
+and peak memory.  Results can be saved, and compared with a saved
+baseline:
+
+    ./bench.py --save baseline.json
+    ... change something ...
+    ./bench.py --baseline baseline.json --threshold 0.1
+
+The comparison fails (exit status 1) if puzzles/sec for any tier has
+dropped by more than the threshold.
+
+Solvers can be compared side by side, e.g. the two hidden single
+strategies:
+
+    ./bench.py --solvers sud2,sud2-counting
+
+--scaling runs tiers of generated puzzles of each box width instead, to
+show how time and memory grow with the size of the grid:
+
+    ./bench.py --scaling 2,3,4,5 --variants 50
+
+--memory reports the memory taken by each puzzle held at once, at box
+widths 3, 4 and 5 by default:
+
+    ./bench.py --memory --variants 100
+"""
+
+import json
+import logging
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import sud2
+
+TIERS = ['simple', 'moderate', 'hard', 'hard1', 'evil']
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_tier(tier, box_width=3):
+    """ Puzzles from a tier's file, as lines for Puzzle.load_from_line(). """
+    lines = []
+    with open(os.path.join(HERE, tier + '.txt')) as source:
+        for text in sud2.iter_puzzle_texts(source, box_width):
+            puzzle = sud2.Puzzle(box_width)
+            puzzle.load_from_iterable(text)
+            lines.append(puzzle.to_line())
+    return lines
+
+
+def transform_puzzle(line, rng, box_width=3):
+    """
+    Return a random puzzle equivalent to line (same solution count and
+    difficulty) by relabelling values, permuting bands and stacks, rows
+    and columns within them, and maybe transposing.
+    """
+    size = box_width ** 2
+    symbols = sud2.SYMBOLS[:size]
+
+    def line_order():
+        bands = range(box_width)
+        rng.shuffle(bands)
+        order = []
+        for band in bands:
+            rows = range(band * box_width, (band + 1) * box_width)
+            rng.shuffle(rows)
+            order.extend(rows)
+        return order
+
+    rows = line_order()
+    cols = line_order()
+    if rng.random() < 0.5:
+        cell = lambda r, c: line[rows[r] * size + cols[c]]
+    else:
+        cell = lambda r, c: line[cols[c] * size + rows[r]]
+    relabel = list(symbols)
+    rng.shuffle(relabel)
+    relabel = dict(zip(symbols, relabel))
+    return ''.join(
+        relabel.get(cell(r, c), '.') for r in range(size) for c in range(size)
+    )
+
+
+def make_corpus(tier, variants, seed):
+    """ A tier's puzzles followed by random transforms of them. """
+    rng = random.Random('{}:{}'.format(seed, tier))
+    lines = load_tier(tier)
+    corpus = list(lines)
+    for i in range(variants):
+        corpus.append(transform_puzzle(lines[i % len(lines)], rng))
+    return corpus
+
+
+def make_grid_corpus(box_width, count, seed, givens=0.6):
+    """
+    Puzzles of any box width: random transforms of a full grid with
+    cells blanked at random, keeping a fraction givens of them.  The
+    puzzles may have more than one solution.  Much below 0.5 givens,
+    large grids get very hard for any solver.
+    """
+    rng = random.Random('{}:box{}'.format(seed, box_width))
+    puzzle = sud2.Puzzle(box_width)
+    sud2.UniqueConstraints.add_to_puzzle(puzzle)
+    sud2.DancingLinks().solve(puzzle)
+    grid = puzzle.to_line()
+    corpus = []
+    for i in range(count):
+        line = transform_puzzle(grid, rng, box_width)
+        corpus.append(''.join(
+            char if rng.random() < givens else '.' for char in line))
+    return corpus
+
+
+def solve_sud2(line, box_width=3):
+    puzzle, status, nodes = sud2.solve_puzzle_text(
+        [line], box_width, search=True)
+    return status == 'solved'
+
+
+def solve_sud2_counting(line, box_width=3):
+    """ solve_sud2() with CountingSinglePosition for SinglePosition. """
+    puzzle, status, nodes = sud2.solve_puzzle_text(
+        [line], box_width, search=True,
+        strategies=(sud2.CandidateLines, sud2.CountingSinglePosition))
+    return status == 'solved'
+
+
+def solve_sud(line, box_width=3):
+    """
+    sud.py is a script with global state, so run it once per puzzle.
+    Its timings include interpreter start-up.  9x9 only.
+    """
+    assert box_width == 3
+    handle, path = tempfile.mkstemp(suffix='.txt')
+    try:
+        with os.fdopen(handle, 'w') as out:
+            for row in range(9):
+                text = line[row * 9:(row + 1) * 9].replace('.', '-')
+                out.write(' '.join(text[i:i + 3] for i in (0, 3, 6)) + '\n')
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(HERE, 'sud.py'), path],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output = process.communicate()[0]
+        return 'Solved!' in output
+    finally:
+        os.remove(path)
+
+SOLVERS = {
+    'sud2': solve_sud2,
+    'sud2-counting': solve_sud2_counting,
+    'sud.py': solve_sud,
+}
+
+
+def percentile(sorted_values, fraction):
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * fraction))
+    return sorted_values[index]
+
+
+def max_rss_kb():
+    """ Peak RSS of this process or any child it has waited for. """
+    import resource
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+def run_tier(solver_name, corpus, box_width=3):
+    """
+    Solve a corpus and return its statistics.  Run in a fresh child
+    process (see run_isolated()) so that peak memory is per tier.
+    """
+    logging.getLogger().setLevel(logging.CRITICAL)
+    sud2.metrics.enabled = False
+    solve = SOLVERS[solver_name]
+    rss_before = max_rss_kb()
+    latencies = []
+    solved = 0
+    start = time.time()
+    for line in corpus:
+        puzzle_start = time.time()
+        if solve(line, box_width):
+            solved += 1
+        latencies.append(time.time() - puzzle_start)
+    elapsed = time.time() - start
+    latencies.sort()
+    return {
+        'puzzles': len(corpus),
+        'box_width': box_width,
+        'solved': solved,
+        'seconds': elapsed,
+        'puzzles_per_sec': len(corpus) / elapsed,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p90': percentile(latencies, 0.90) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+            'max': latencies[-1] * 1000,
+        },
+        'peak_rss_kb': max_rss_kb(),
+        'rss_growth_kb': max_rss_kb() - rss_before,
+    }
+
+
+def _run_tier_in_child(args):
+    return run_tier(*args)
+
+
+def run_isolated(function, *args):
+    """ Call function(*args) in a fresh child process. """
+    import multiprocessing
+    pool = multiprocessing.Pool(1)
+    try:
+        return pool.apply(function, args)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def run(solvers, tiers, variants, seed):
+    results = {}
+    for solver_name in solvers:
+        results[solver_name] = {}
+        for tier in tiers:
+            corpus = make_corpus(tier, variants, seed)
+            results[solver_name][tier] = run_isolated(
+                _run_tier_in_child, (solver_name, corpus))
+    return results
+
+
+def measure_memory(box_width, count, seed):
+    """
+    Memory per puzzle held at once, after loading and the strategies
+    but before any search, as in a batch worker or a search frontier.
+    Run in a fresh child process, since it reads the growth of peak RSS.
+    """
+    logging.getLogger().setLevel(logging.CRITICAL)
+    sud2.metrics.enabled = False
+    corpus = make_grid_corpus(box_width, count, seed)
+    rss_before = max_rss_kb()
+    puzzles = [sud2.solve_puzzle_text([line], box_width)[0]
+               for line in corpus]
+    growth = max_rss_kb() - rss_before
+    return {
+        'box_width': box_width,
+        'puzzles': len(puzzles),
+        'kb_per_puzzle': float(growth) / len(puzzles),
+    }
+
+
+def run_memory(box_widths, count, seed):
+    results = {}
+    for box_width in box_widths:
+        results['box{}'.format(box_width)] = run_isolated(
+            measure_memory, box_width, count, seed)
+    return results
+
+
+def report_memory(results, out=sys.stdout):
+    out.write('{:9} {:>8} {:>12}\n'.format('tier', 'puzzles', 'KB/puzzle'))
+    for tier, stats in sorted(results.items()):
+        out.write('{:9} {:>8} {:12.1f}\n'.format(
+            tier, stats['puzzles'], stats['kb_per_puzzle']))
+
+
+def run_scaling(solvers, box_widths, count, seed):
+    """ As run(), with a tier of generated puzzles per box width. """
+    results = {}
+    for solver_name in solvers:
+        results[solver_name] = {}
+        for box_width in box_widths:
+            corpus = make_grid_corpus(box_width, count, seed)
+            results[solver_name]['box{}'.format(box_width)] = run_isolated(
+                _run_tier_in_child, (solver_name, corpus, box_width))
+    return results
+
+
+def report(results, out=sys.stdout):
+    out.write('{:13} {:9} {:>7} {:>7} {:>9} {:>9} {:>9} {:>9} {:>10}\n'.format(
+        'solver', 'tier', 'solved', 'puz/s',
+        'p50 ms', 'p90 ms', 'p99 ms', 'max ms', 'peak KB'))
+    for solver_name in sorted(results):
+        for tier, stats in sorted(results[solver_name].items(),
+                                  key=lambda item: tier_order(item[0])):
+            latency = stats['latency_ms']
+            out.write(
+                '{:13} {:9} {:>7} {:7.1f} {:9.2f} {:9.2f} {:9.2f} {:9.2f} '
+                '{:>10}\n'.format(
+                    solver_name, tier,
+                    '{}/{}'.format(stats['solved'], stats['puzzles']),
+                    stats['puzzles_per_sec'], latency['p50'], latency['p90'],
+                    latency['p99'], latency['max'], stats['peak_rss_kb']))
+
+
+def tier_order(tier):
+    if tier in TIERS:
+        return (TIERS.index(tier), tier)
+    return (len(TIERS), tier)
+
+
+def compare(results, baseline, threshold, out=sys.stdout):
+    """
+    Report puzzles/sec against a baseline.  Returns the list of
+    (solver, tier) pairs which regressed by more than threshold.
+    """
+    regressions = []
+    for solver_name in sorted(results):
+        for tier in sorted(results[solver_name], key=tier_order):
+            try:
+                before = baseline[solver_name][tier]['puzzles_per_sec']
+            except KeyError:
+                continue
+            after = results[solver_name][tier]['puzzles_per_sec']
+            change = after / before - 1
+            flag = ''
+            if change < -threshold:
+                flag = '  REGRESSION'
+                regressions.append((solver_name, tier))
+            out.write(
+                '{:13} {:9} {:7.1f} -> {:7.1f} puz/s {:+6.1%}{}\n'.format(
+                    solver_name, tier, before, after, change, flag))
+    return regressions
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Benchmark the solvers.')
+    parser.add_argument('--solvers', default='sud2',
+                        help='comma separated, from: ' +
+                             ', '.join(sorted(SOLVERS)))
+    parser.add_argument('--tiers', default=','.join(TIERS),
+                        help='comma separated puzzle files, without .txt')
+    parser.add_argument('--variants', type=int, default=200,
+                        help='generated puzzles per tier')
+    parser.add_argument('--scaling', metavar='BOX_WIDTHS',
+                        help='comma separated box widths; benchmark '
+                             'generated puzzles of each instead of --tiers')
+    parser.add_argument('--memory', metavar='BOX_WIDTHS', nargs='?',
+                        const='3,4,5',
+                        help='comma separated box widths (default 3,4,5); '
+                             'report memory per puzzle held, over '
+                             '--variants generated puzzles of each, '
+                             'instead of timing')
+    parser.add_argument('--seed', default='0',
+                        help='seed for generating puzzles')
+    parser.add_argument('--save', metavar='FILE',
+                        help='save results as JSON')
+    parser.add_argument('--baseline', metavar='FILE',
+                        help='compare with results saved by --save')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='puzzles/sec drop which counts as a '
+                             'regression, as a fraction')
+    args = parser.parse_args()
+
+    if args.memory:
+        report_memory(run_memory(map(int, args.memory.split(',')),
+                                 args.variants, args.seed))
+        return
+
+    if args.scaling:
+        results = run_scaling(args.solvers.split(','),
+                              map(int, args.scaling.split(',')),
+                              args.variants, args.seed)
+    else:
+        results = run(args.solvers.split(','), args.tiers.split(','),
+                      args.variants, args.seed)
+    report(results)
+
+    if args.save:
+        with open(args.save, 'w') as out:
+            json.dump({
+                'time': time.time(),
+                'python': sys.version,
+                'variants': args.variants,
+                'seed': args.seed,
+                'results': results,
+            }, out, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as source:
+            baseline = json.load(source)['results']
+        print
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+
+# The End
+# vim:foldmethod=indent:foldnestmax=2
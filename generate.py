@@ -0,0 +1,192 @@
+#!/usr/bin/env python2
+
+"""
+Generates puzzles with a unique solution, one per line in the format
+read by sud2.py --batch:
+
+    ./generate.py -n 100 --difficulty medium --seed 1 -j 4 > puzzles.txt
+
+Each puzzle starts as a random full grid.  Givens are then removed in
+random order, putting each back if the puzzle would no longer be
+solvable by the strategies of the target difficulty:
+
+- simple: Single Position and Single Candidate
+- medium: those plus Candidate Lines
+- hard: anything, so long as the solution stays unique; checked by
+  exact cover search, which stops at the second solution
+
+Strategies only make sound deductions, so a puzzle they solve has a
+unique solution.  Puzzles which turn out easier than the target are
+thrown away.
+
+Puzzle n of a seed is the same however many are generated and however
+many processes generate them.
+"""
+
+import itertools
+import logging
+import random
+import sys
+
+import sud2
+
+DIFFICULTIES = ['simple', 'medium', 'hard']
+
+# Strategies for each difficulty, added after UniqueConstraints.
+STRATEGIES = {
+    'simple': [sud2.SinglePosition],
+    'medium': [sud2.CandidateLines, sud2.SinglePosition],
+}
+
+
+def load(line, box_width):
+    """ Puzzle with UniqueConstraints, or None if the givens clash. """
+    puzzle = sud2.Puzzle(box_width)
+    try:
+        sud2.UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_line(line)
+    except sud2.Contradiction:
+        return None
+    return puzzle
+
+
+def solves(line, box_width, strategies):
+    """ True if the strategies alone solve the puzzle. """
+    puzzle = load(line, box_width)
+    if puzzle is None:
+        return False
+    try:
+        for strategy in strategies:
+            strategy.add_to_puzzle(puzzle)
+    except sud2.Contradiction:
+        return False
+    return puzzle.is_solved()
+
+
+def is_unique(line, box_width):
+    puzzle = load(line, box_width)
+    if puzzle is None:
+        return False
+    solutions = sud2.DancingLinks().solutions(puzzle, limit=2)
+    return len(list(solutions)) == 1
+
+
+def grade(line, box_width=3):
+    """
+    The easiest difficulty whose strategies solve the puzzle, or 'hard'
+    if they all stall.
+    """
+    for difficulty in DIFFICULTIES[:-1]:
+        if solves(line, box_width, STRATEGIES[difficulty]):
+            return difficulty
+    return 'hard'
+
+
+def random_grid(rng, box_width=3):
+    puzzle = sud2.Puzzle(box_width)
+    sud2.UniqueConstraints.add_to_puzzle(puzzle)
+    sud2.DancingLinks(rng=rng).solve(puzzle)
+    return puzzle.to_line()
+
+
+def make_puzzle(rng, box_width=3, difficulty='medium'):
+    """
+    Try to make a puzzle of the difficulty from a new random grid.
+    Returns None if it came out easier.
+    """
+    if difficulty == 'hard':
+        keep = lambda line: is_unique(line, box_width)
+    else:
+        strategies = STRATEGIES[difficulty]
+        keep = lambda line: solves(line, box_width, strategies)
+
+    line = list(random_grid(rng, box_width))
+    cells = range(len(line))
+    rng.shuffle(cells)
+    for index in cells:
+        given = line[index]
+        line[index] = '.'
+        if not keep(''.join(line)):
+            line[index] = given
+    line = ''.join(line)
+    if grade(line, box_width) != difficulty:
+        return None
+    return line
+
+
+def generate_one(args):
+    """
+    Puzzle number of a seed.  Takes a single picklable argument for
+    multiprocessing.
+    """
+    number, box_width, difficulty, seed = args
+    rng = random.Random('{}:{}'.format(seed, number))
+    while True:
+        line = make_puzzle(rng, box_width, difficulty)
+        if line is not None:
+            return line
+
+
+def generate(box_width=3, difficulty='medium', seed=0, count=None, jobs=1):
+    """
+    Generate count puzzles, or carry on forever if count is None.
+    With jobs > 1, puzzles are made by a pool of worker processes, a few
+    per worker at a time so that an endless stream stays bounded.
+    """
+    if difficulty not in DIFFICULTIES:
+        raise ValueError("unknown difficulty {!r}".format(difficulty))
+    if count is None:
+        numbers = itertools.count()
+    else:
+        numbers = iter(xrange(count))
+    items = ((number, box_width, difficulty, seed) for number in numbers)
+
+    if jobs <= 1:
+        for item in items:
+            yield generate_one(item)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs)
+    try:
+        while True:
+            window = list(itertools.islice(items, jobs * 4))
+            if not window:
+                break
+            for line in pool.imap(generate_one, window):
+                yield line
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Generate puzzles with a unique solution.')
+    parser.add_argument('-n', '--count', type=int, default=None,
+                        help='number of puzzles (default: no end)')
+    parser.add_argument('--boxwidth', type=int, default=3,
+                        help='box width in cells')
+    parser.add_argument('--difficulty', choices=DIFFICULTIES,
+                        default='medium',
+                        help='which strategies the puzzles need')
+    parser.add_argument('--seed', default='0',
+                        help='seed, for reproducible puzzles')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.CRITICAL)
+    sud2.metrics.enabled = False
+    for line in generate(args.boxwidth, args.difficulty, args.seed,
+                         args.count, args.jobs):
+        sys.stdout.write(line + '\n')
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
+
+# The End
+# vim:foldmethod=indent:foldnestmax=2
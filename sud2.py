@@ -1,7 +1,13 @@
 #!/usr/bin/env python2
 
 import logging
-import pprint
+import re
+import SocketServer
+import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from itertools import count
 
 
 class Metrics:
@@ -13,31 +19,198 @@ class Metrics:
 
     If these numbers can be reduced, it should make the solvers more efficient.
 
+    Also records:
+    - timers: calls and cumulative wall time of each strategy callback,
+      made through call().  Only when timing is set, since reading the
+      clock twice a callback slows solving by a fifth or more.
+    - placements and eliminations each strategy caused, counted by the
+      Propagator as "<Strategy>.placements" and "<Strategy>.eliminations".
+    - histograms, e.g. of per-puzzle latency, in power of two buckets.
+
+    Set enabled to False to skip all of it.
     """
-    def __init__(self):
-        self.metrics = {}
+    def __init__(self, enabled=True, timing=False):
+        self.enabled = enabled
+        self.timing = timing
+        self.metrics = {}       # counter name: count
+        self.timers = {}        # timer name: [calls, seconds]
+        self.histograms = {}    # histogram name: {bucket: count}
+        # Name of the strategy whose callback is running, if any.
+        self.source = None
 
     def inc(self, name):
         """
         This must be called at appropriate points in the code.
         """
+        if not self.enabled:
+            return
         if name not in self.metrics:
             self.metrics[name] = 1
         else:
             self.metrics[name] += 1
 
+    def call(self, lsnr, method_name, cell, value):
+        """
+        Call a listener callback, timing it and marking the listener's
+        class as the source of any cell changes it queues.
+        """
+        name = lsnr.__class__.__name__
+        saved = self.source
+        self.source = name
+        start = time.time()
+        try:
+            getattr(lsnr, method_name)(cell, value)
+        finally:
+            self.add_time(name + '.' + method_name, time.time() - start)
+            self.source = saved
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+
+    def observe(self, name, value):
+        """
+        Add a non-negative value to a histogram.  A value falls into the
+        bucket of the smallest power of two above it.
+        """
+        if not self.enabled:
+            return
+        bucket = 1 << int(value).bit_length()
+        histogram = self.histograms.setdefault(name, {})
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+
+    def clear(self):
+        self.metrics = {}
+        self.timers = {}
+        self.histograms = {}
+
+    def to_dict(self):
+        return {
+            'counters': dict(self.metrics),
+            'timers': dict(
+                (name, list(timer)) for name, timer in self.timers.items()),
+            'histograms': dict(
+                (name, dict(histogram))
+                for name, histogram in self.histograms.items()),
+        }
+
+    def merge(self, other):
+        """
+        Add in the results of another Metrics' to_dict(), e.g. from a
+        worker process.
+        """
+        for name, count in other['counters'].items():
+            self.metrics[name] = self.metrics.get(name, 0) + count
+        for name, (calls, seconds) in other['timers'].items():
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+        for name, buckets in other['histograms'].items():
+            histogram = self.histograms.setdefault(name, {})
+            for bucket, count in buckets.items():
+                histogram[bucket] = histogram.get(bucket, 0) + count
+
+    def to_json(self):
+        import json
+        return json.dumps(self.to_dict(), indent=1, sort_keys=True)
+
     def to_string(self):
         from pprint import pformat
-        return pformat(self.metrics)
+        if not self.timers and not self.histograms:
+            return pformat(self.metrics)
+        return pformat(self.to_dict())
 
 metrics = Metrics()
 
 
+class Tracer(object):
+    """
+    Records trace events in a bounded ring buffer, to be dumped later.
+
+    Trace points in hot paths are written as:
+
+        if tracer.enabled:
+            tracer.record('event', arg1, arg2)
+
+    so a disabled tracer costs one attribute test, with no formatting or
+    allocation.  Events are tuples of the event name and its arguments;
+    they are only formatted by dump().
+    """
+    def __init__(self, size=10000):
+        self.enabled = False
+        self.events = deque(maxlen=size)
+        self.count = 0      # events recorded, including those dropped
+
+    def enable(self, size=None):
+        if size is not None:
+            self.events = deque(self.events, maxlen=size)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def record(self, event, *args):
+        self.count += 1
+        self.events.append((event,) + args)
+
+    def dump(self, out):
+        """
+        Write the buffered events, oldest first, one per line.
+        """
+        dropped = self.count - len(self.events)
+        if dropped > 0:
+            out.write("... {} earlier events dropped\n".format(dropped))
+        for event in self.events:
+            out.write(' '.join(str(x) for x in event) + '\n')
+
+tracer = Tracer()
+
+
+# Default characters for cell values, in value order.  Box widths above 3
+# carry on with letters, so up to 36 values (box width 6) with digits and
+# capitals; pass Puzzle() symbols for anything else.
+SYMBOLS = '123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+# Characters for unknown cells in the one line per puzzle format.
+BLANKS = '.0-'
+
+
+def check_symbols(symbols, size):
+    """
+    Return symbols for values of a grid size wide, defaulting to the
+    start of SYMBOLS.  Raises ValueError unless there is one distinct
+    character per value, none of them blanks or white space.
+    """
+    if symbols is None:
+        if size > len(SYMBOLS):
+            raise ValueError("no default symbols for {} values".format(size))
+        return SYMBOLS[:size]
+    if len(symbols) != size or len(set(symbols)) != size:
+        raise ValueError("need {} distinct symbols, found {!r}".format(
+            size, symbols))
+    for char in symbols:
+        if char in BLANKS or char.isspace() or char in '#|':
+            raise ValueError("{!r} can not be a symbol".format(char))
+    return symbols
+
+
 class SingleCandidate(Exception):
     # Only one candidate remains after remove.
     pass
 
 
+class Contradiction(AssertionError):
+    # The puzzle state has no solution, e.g. a cell has lost every
+    # candidate.  Search catches these to backtrack.
+    pass
+
+
 class CandidateSet(set):
     """
     Like a Set but raises exceptions when:
@@ -66,15 +239,251 @@ class CandidateSet(set):
         return list(self)[0]  # grab any
 
 
-class Cell():
-    def __init__(self, candidate_values, row=-1, col=-1):
+def popcount(mask):
+    """ Number of bits set in an int mask. """
+    return bin(mask).count('1')
+
+
+def lowest_bit_index(mask):
+    """ Position of the lowest set bit in a non-zero int mask. """
+    return (mask & -mask).bit_length() - 1
+
+
+class Alphabet(object):
+    """
+    The ordered list of values a cell may hold.  Each value is given a bit
+    position so that a set of candidates can be held in a single int.
+
+    Alphabets are shared by every cell of a puzzle; use Alphabet.get() so
+    that equal value lists return the same object.  Only alphabets still
+    in use are kept, since the symbols may come from server requests.
+    """
+    _alphabets = weakref.WeakValueDictionary()
+
+    @classmethod
+    def get(cls, values):
+        values = tuple(values)
+        alphabet = cls._alphabets.get(values)
+        if alphabet is None:
+            alphabet = cls._alphabets[values] = cls(values)
+        return alphabet
+
+    def __init__(self, values):
+        self.values = tuple(values)
+        self.bit = dict((v, 1 << i) for i, v in enumerate(self.values))
+        self.full_mask = (1 << len(self.values)) - 1
+
+    def __len__(self):
+        return len(self.values)
+
+    def __repr__(self):
+        return "Alphabet({!r})".format(self.values)
+
+
+class CandidateMask(object):
+    """
+    Same behaviour as CandidateSet, but the candidates are held as bits of
+    a single int, indexed by the cell's Alphabet.  Membership, len() and
+    removal are a few integer operations rather than set hashing.
+    """
+    __slots__ = ('alphabet', 'mask')
+
+    def __init__(self, candidate_values, alphabet=None):
+        if alphabet is None:
+            alphabet = Alphabet.get(sorted(candidate_values))
+        self.alphabet = alphabet
+        self.mask = 0
+        bit = alphabet.bit
+        for value in candidate_values:
+            self.mask |= bit[value]
+
+    def remove_candidate(self, value):
+        mask = self.mask
+        if mask & (mask - 1) == 0:
+            raise Contradiction("Attempt to remove final candidate")
+        bit = self.alphabet.bit[value]
+        if not mask & bit:
+            raise KeyError(value)
+        mask ^= bit
+        self.mask = mask
+
+        if mask & (mask - 1) == 0:
+            raise SingleCandidate
+
+    def has_single_candidate(self):
+        mask = self.mask
+        return mask != 0 and mask & (mask - 1) == 0
+
+    def get_any_candidate(self):
+        return self.alphabet.values[lowest_bit_index(self.mask)]
+
+    def add(self, value):
+        self.mask |= self.alphabet.bit[value]
+
+    def clear(self):
+        self.mask = 0
+
+    def __contains__(self, value):
+        return self.mask & self.alphabet.bit.get(value, 0) != 0
+
+    def __len__(self):
+        return popcount(self.mask)
+
+    def __iter__(self):
+        values = self.alphabet.values
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield values[low.bit_length() - 1]
+            mask ^= low
+
+    def __eq__(self, other):
+        if isinstance(other, CandidateMask) and \
+                other.alphabet is self.alphabet:
+            return self.mask == other.mask
+        return set(self) == set(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "CandidateMask({!r})".format(list(self))
+
+
+# Undo functions for trail entries; see Puzzle.mark().  A trail entry is a
+# tuple of one of these and its arguments.
+
+def _undo_store(container, key, item):
+    container[key] = item
+
+
+def _undo_add(container, item):
+    container.remove(item)
+
+
+def _undo_remove(container, item):
+    container.add(item)
+
+
+def _undo_list_remove(container, item):
+    container.append(item)
+
+
+def _undo_append(container):
+    container.pop()
+
+
+def _undo_remove_candidate(cell, mask):
+    cell.candidate_set.mask = mask
+
+
+def _undo_set_value(cell, mask, value_set_listeners,
+                    candidate_removed_listeners):
+    cell.value = None
+    cell.candidate_set.mask = mask
+    cell.cell_value_set_listeners = value_set_listeners
+    cell.candidate_removed_listeners = candidate_removed_listeners
+
+
+class Propagator(object):
+    """
+    Work queue of pending value assignments and candidate removals.
+
+    Cells attached to a Propagator don't call their listeners recursively.
+    Instead set_value() and remove_candidate() queue the change, and the
+    outermost call drains the queue in a loop.  Listeners are unchanged:
+    the cell changes they make are queued as more work, so stack depth
+    stays bounded whatever the grid size.
+
+    Assignments are drained before removals since each one makes many
+    removals redundant.  Removals which have gone stale by the time they
+    are drained (candidate already gone) are skipped.
+
+    Each item remembers the strategy that queued it (metrics.source), so
+    that placements and eliminations can be credited to strategies.
+    """
+    def __init__(self):
+        self.assignments = deque()
+        self.removals = deque()
+        self.running = False
+
+    def set_value(self, cell, value):
+        self.assignments.append((cell, value, metrics.source))
+        if not self.running:
+            self.run()
+
+    def remove_candidate(self, cell, value):
+        self.removals.append((cell, value, metrics.source))
+        if not self.running:
+            self.run()
+
+    def run(self):
+        """
+        Drain the queues.  If a cell change raises an exception, pending
+        work is discarded, since it was derived from a broken state.
+        """
+        assignments = self.assignments
+        removals = self.removals
+        self.running = True
+        try:
+            while assignments or removals:
+                if assignments:
+                    cell, value, source = assignments.popleft()
+                    if source is not None and cell.value is None:
+                        metrics.inc(source + '.placements')
+                    cell.apply_value(value)
+                else:
+                    cell, value, source = removals.popleft()
+                    if value in cell.candidate_set:
+                        if source is not None:
+                            metrics.inc(source + '.eliminations')
+                        cell.apply_remove_candidate(value)
+                    else:
+                        metrics.inc('Propagator.stale_removal')
+        finally:
+            self.running = False
+            assignments.clear()
+            removals.clear()
+
+
+# Indexes for cells which are not in a grid, so that they never compare
+# equal to grid cells or each other.
+_standalone_cell_index = count(-1, -1)
+
+
+class Cell(object):
+    # There are hundreds of cells per puzzle, so no per-instance dict.
+    __slots__ = (
+        'value', 'index', 'name', 'row', 'col', 'candidate_set',
+        'cell_value_set_listeners', 'candidate_removed_listeners',
+        'propagator', 'trail',
+    )
+
+    def __init__(self, candidate_values, row=-1, col=-1, alphabet=None,
+                 index=None):
+        """
+        index is the cell's number in its grid (see Topology), and
+        identifies it for hashing and equality.
+        """
         self.value = None
-        self.name = "C{}{}".format(row, col)
+        if index is None:
+            index = next(_standalone_cell_index)
+        self.index = index
+        if row < 10 and col < 10:
+            self.name = "C{}{}".format(row, col)
+        else:
+            self.name = "C{},{}".format(row, col)
         self.row = row
         self.col = col
-        self.candidate_set = CandidateSet(candidate_values)
+        self.candidate_set = CandidateMask(candidate_values, alphabet)
         self.cell_value_set_listeners = []
         self.candidate_removed_listeners = []
+        # When set, changes are queued rather than propagated recursively.
+        self.propagator = None
+        # When set, changes are journaled here so they can be undone.
+        self.trail = None
 
     def add_candidate(self, value):
         """
@@ -84,6 +493,14 @@ class Cell():
         if type(value) is not str:
             raise AssertionError("add_candidate() needs a str")
 
+        if value not in self.candidate_set.alphabet.bit:
+            if self.index >= 0:
+                raise KeyError(
+                    "{!r} is not a value of {}'s grid".format(value, self.name))
+            # not in a grid, so the alphabet can grow
+            self.candidate_set = CandidateMask(
+                list(self.candidate_set) + [value])
+            return
         self.candidate_set.add(value)
 
     def onload_check_single_candidate(self):
@@ -105,8 +522,10 @@ class Cell():
         *BYPASSES* propagation.
         Used after candidates have been loaded from an external source.
         """
-        self.candidate_set.clear()
-        self.candidate_set = CandidateSet(candidate_values)
+        alphabet = self.candidate_set.alphabet
+        if len(alphabet) == 0:
+            alphabet = None
+        self.candidate_set = CandidateMask(candidate_values, alphabet)
 
     def add_cell_value_set_listener(self, lsnr):
         self.cell_value_set_listeners.append(lsnr)
@@ -115,10 +534,13 @@ class Cell():
         self.candidate_removed_listeners.append(lsnr)
 
     def __hash__(self):
-        return hash(self.name)
+        return self.index
 
     def __eq__(self, other):
-        return self.name == other.name
+        return self.index == other.index
+
+    def __ne__(self, other):
+        return self.index != other.index
 
     def get_value(self):
         return self.value
@@ -133,6 +555,24 @@ class Cell():
             return str(self.value)
 
     def set_value(self, value):
+        """
+        Set the cell value, via the propagator if there is one.
+        """
+        if self.propagator is not None:
+            self.propagator.set_value(self, value)
+        else:
+            self.apply_value(value)
+
+    def remove_candidate(self, value):
+        """
+        Remove a candidate, via the propagator if there is one.
+        """
+        if self.propagator is not None:
+            self.propagator.remove_candidate(self, value)
+        else:
+            self.apply_remove_candidate(value)
+
+    def apply_value(self, value):
         """
         - Raises error if value not in candidate set.
         - Clears candidate set.
@@ -142,51 +582,89 @@ class Cell():
 
         Does nothing if cell already set.
         """
-        logging.info("%s set_value(%s) called", self.name, value)
-        # import pdb; pdb.set_trace()
         if self.value is not None:
             metrics.inc('Cell.already_set')
-            logging.info("%s set_value(%s) already set", self.name, value)
+            if tracer.enabled:
+                tracer.record('already_set', self.name, value)
             return
 
         # if value not in self:
         if value not in self.candidate_set:
-            raise AssertionError("Value is not a candidate")
+            raise Contradiction("Value is not a candidate")
 
         self.value = value
 
+        if tracer.enabled:
+            tracer.record('set_value', self.name, value)
+
+        value_set_listeners = self.cell_value_set_listeners
+        candidate_removed_listeners = self.candidate_removed_listeners
+        if self.trail is not None:
+            self.trail.append((
+                _undo_set_value, self, self.candidate_set.mask,
+                value_set_listeners, candidate_removed_listeners
+            ))
+
         self.candidate_set.clear()    # remove all candidates
-        for lsnr in self.cell_value_set_listeners:
-            logging.info("{} set_value({}) calling listener {}".format(
-                self.name, value, repr(lsnr))
-            )
-            lsnr.on_value_set(self, value)
+        for lsnr in value_set_listeners:
+            if metrics.timing:
+                metrics.call(lsnr, 'on_value_set', self, value)
+            elif metrics.enabled:
+                saved = metrics.source
+                metrics.source = lsnr.__class__.__name__
+                try:
+                    lsnr.on_value_set(self, value)
+                finally:
+                    metrics.source = saved
+            else:
+                lsnr.on_value_set(self, value)
 
         # delete all listeners, since there can
         # be no further changes to this cell
-        del self.cell_value_set_listeners[:]
-        del self.candidate_removed_listeners[:]
+        if self.trail is not None:
+            # keep the old lists on the trail
+            self.cell_value_set_listeners = []
+            self.candidate_removed_listeners = []
+        else:
+            del value_set_listeners[:]
+            del candidate_removed_listeners[:]
 
-    def remove_candidate(self, value):
+    def apply_remove_candidate(self, value):
         """
         - Removes candidate value from cell and notifies
           any candidate_removed listeners.
         - If one candidate remains, calls set_value() which
           may propagate.
         """
-        logging.debug(
-            "%s remove_candidate %s", self.name, value)
+        if tracer.enabled:
+            tracer.record('remove_candidate', self.name, value)
 
+        if self.trail is not None:
+            self.trail.append(
+                (_undo_remove_candidate, self, self.candidate_set.mask))
         try:
             self.candidate_set.remove_candidate(value)
         except SingleCandidate:
-            self.set_value(list(self.candidate_set)[0])  # grab any
+            saved = metrics.source
+            if metrics.enabled:
+                metrics.source = 'SingleCandidate'
+            try:
+                self.set_value(self.candidate_set.get_any_candidate())
+            finally:
+                metrics.source = saved
 
         for lsnr in self.candidate_removed_listeners:
-            logging.debug("{} remove_candidate({}) calling listener {}".format(
-                self.name, value, repr(lsnr))
-            )
-            lsnr.on_candidate_removed(self, value)
+            if metrics.timing:
+                metrics.call(lsnr, 'on_candidate_removed', self, value)
+            elif metrics.enabled:
+                saved = metrics.source
+                metrics.source = lsnr.__class__.__name__
+                try:
+                    lsnr.on_candidate_removed(self, value)
+                finally:
+                    metrics.source = saved
+            else:
+                lsnr.on_candidate_removed(self, value)
 
 
 class CellGroup(object):
@@ -194,6 +672,8 @@ class CellGroup(object):
     A group of cell references with an optional name.
     Used to implement boxes, rows and columns.
     """
+    __slots__ = ('name', 'cells')
+
     def __init__(self, cells=[], name="CellGroup"):
         """
         Init will a list of cells and optional name.
@@ -211,20 +691,17 @@ class UniqueConstraints(object):
     If the group already contains repeats, then an Exception
     is raised with a list of violations.
     """
+    __slots__ = ('puzzle', 'name', 'cell_group', 'cells', 'values')
 
     @staticmethod
     def add_to_puzzle(puzzle=None):
 
         assert(puzzle is not None)
+        puzzle.strategies.append(UniqueConstraints)
 
         for cell_group in puzzle.cell_groups:
-            # TODO worry about GC
-            # dummy = UniqueConstraints(
-            #     cell_group,
-            #     puzzle=puzzle,
-            #     name = cell_group.name + '.UniqueConstraints'
-            # )
-            print "not implemented yet"
+            # Instances are kept alive by the listener lists of the cells.
+            UniqueConstraints(cell_group, puzzle=puzzle)
 
     def __init__(self, cell_group, puzzle=None, name=None):
         """
@@ -243,6 +720,7 @@ class UniqueConstraints(object):
         else:
             self.name = name
 
+        self.cell_group = cell_group
         self.cells = list(cell_group.cells)      # store a copy
 
         # Check for violations.
@@ -264,17 +742,46 @@ class UniqueConstraints(object):
         if len(violations) > 0:
             raise Exception(self.name + " broken", violations)
 
+        # Values already placed in the group.
+        self.values = set(cell_for_value)
+
+    def reset(self):
+        """
+        As when added to the grid as it is now; see Puzzle.reset() and
+        Puzzle.restore_state().  Raises Contradiction if the group
+        repeats a value.
+        """
+        self.cells = []
+        self.values = set()
+        for cell in self.cell_group.cells:
+            if cell.value is None:
+                self.cells.append(cell)
+            elif cell.value in self.values:
+                raise Contradiction(
+                    "{} repeats {}".format(self.name, cell.value))
+            else:
+                self.values.add(cell.value)
+
     def on_value_set(self, cell, value):
         """
         Remove this cell from the constraint group
         """
+        if value in self.values:
+            # A queued assignment beat the removal of its value.
+            raise Contradiction(
+                "{} repeats {} in {}".format(self.name, value, cell.name))
+        self.values.add(value)
         self.cells.remove(cell)
+        if cell.trail is not None:
+            cell.trail.append((_undo_add, self.values, value))
+            cell.trail.append((_undo_list_remove, self.cells, cell))
+        bit = cell.candidate_set.alphabet.bit[value]
         for neighbor in self.cells:
             # It's possible that an over-lapping contstraint
             # group has already deleted the candidate value
             # from this neighbor, so only remove candidate if
             # already there, otherwise we'll get a key error.
-            if value in neighbor.candidate_set:
+            if neighbor.candidate_set.mask & bit:
                 if self.puzzle is not None:
                     self.puzzle.log_solution_step(
                         "RemoveCandidate {} from {} {}".format(
@@ -290,62 +797,68 @@ class UniqueConstraints(object):
         return self.name
 
 
-class SinglePosition:
+class SinglePosition(object):
     """
     Detects when a value has been eliminated from the candidates of all but
     one cell in a cell group; then the cell value is known.
     """
+    __slots__ = ('puzzle', 'possible_cells_by_value', 'cells', 'bit_for_cell',
+                 'name')
+
     @staticmethod
     def add_to_puzzle(puzzle=None):
         """
         Note: not an instance method.
         """
         assert(puzzle is not None)
+        puzzle.strategies.append(SinglePosition)
 
         for cell_group in puzzle.cell_groups:
-            # TODO wonder about GC
-            # dummy = SinglePosition(cell_group, puzzle=puzzle)
-            print "not implemented yet"
+            # Instances are kept alive by the listener lists of the cells.
+            SinglePosition(cell_group, puzzle=puzzle)
 
     def __init__(self, cell_group, puzzle=None):
         """
         Create a dictionary of possible cells
         for each possible value in a constraint group.
-        I.e. a dictionary of lists of cells indexed by candidate values.
+        The possible cells of a value are a bitset of their positions in
+        the group: bit i is set if self.cells[i] may hold the value.
         """
 
         # import pdb; pdb.set_trace()
         self.puzzle = puzzle
-        self.possible_cells_by_value = {}
+        self.possible_cells_by_value = possible = {}
         self.cells = list(cell_group.cells)   # make a copy
+        self.bit_for_cell = dict(
+            (cell.index, 1 << i) for i, cell in enumerate(self.cells))
         self.name = cell_group.name + ".SinglePosition"
-        for cell in self.cells:
-            # for candidate_value in cell:
-            for candidate_value in cell.candidate_set:
-                if candidate_value in self.possible_cells_by_value:
-                    self.possible_cells_by_value.get(candidate_value).add(cell)
-                else:
-                    self.possible_cells_by_value[candidate_value] = set([cell])
+        for i, cell in enumerate(self.cells):
+            bit = 1 << i
+            for value in cell.candidate_set:
+                possible[value] = possible.get(value, 0) | bit
 
         for cell in self.cells:
             cell.add_cell_candidate_removed_listener(self)
             cell.add_cell_value_set_listener(self)
 
         # If any values have only 1 possible cell, we have found some values
-        for value in list(self.possible_cells_by_value):
+        for value in list(possible):
             # import pdb; pdb.set_trace()
-            if value not in self.possible_cells_by_value:
+            if value not in possible:
                 metrics.inc('SinglePosition.miss0')
                 continue
-            possible_cells = self.possible_cells_by_value[value]
-            if len(possible_cells) == 1:
-                self._found_value(iter(possible_cells).next(), value)
+            possible_cells = possible[value]
+            if possible_cells & (possible_cells - 1) == 0:
+                self._found_value(
+                    self.cells[possible_cells.bit_length() - 1], value)
 
     def __repr__(self):
         return self.name
 
     def _found_value(self, cell, value):
         # we have found the last possible cell for this value
+        if tracer.enabled:
+            tracer.record('SinglePosition.found', self.name, cell.name, value)
         if self.puzzle is not None:
             self.puzzle.log_solution_step(
                 "SinglePosition for {} in {} {}".format(
@@ -355,247 +868,522 @@ class SinglePosition:
     def on_value_set(self, changed_cell, value):
         # no need to watch the value any more
         if value in self.possible_cells_by_value:
+            if changed_cell.trail is not None:
+                changed_cell.trail.append((
+                    _undo_store, self.possible_cells_by_value, value,
+                    self.possible_cells_by_value[value]
+                ))
             del self.possible_cells_by_value[value]
         else:
             metrics.inc('SinglePosition.miss1')
 
     def on_candidate_removed(self, cell, value):
         # delete cell from set of possibilities for that value
-        if value not in self.possible_cells_by_value:
+        possible = self.possible_cells_by_value
+        if value not in possible:
             metrics.inc('SinglePosition.miss2')
             return
 
-        possible_cells = self.possible_cells_by_value[value]
-        possible_cells.discard(cell)
-        if len(possible_cells) == 1:
+        possible_cells = possible[value]
+        bit = self.bit_for_cell[cell.index]
+        if possible_cells & bit:
+            if cell.trail is not None:
+                cell.trail.append(
+                    (_undo_store, possible, value, possible_cells))
+            possible_cells ^= bit
+            possible[value] = possible_cells
+        # exactly one bit left
+        if possible_cells and possible_cells & (possible_cells - 1) == 0:
+            metrics.inc('SinglePosition.found')
+            self._found_value(
+                self.cells[possible_cells.bit_length() - 1], value)
+
+
+class CountingSinglePosition(object):
+    """
+    Finds the same values as SinglePosition, but keeps for each value
+    only a count of the cells of the group which can hold it and the XOR
+    of their positions in the group.  When the count drops to one, the
+    XOR is the position of the last cell, so there are no sets to update
+    or search.
+
+    Unlike SinglePosition, a cell whose value is set is taken out of the
+    counts of its other candidates, so values are found sooner, and a
+    value with nowhere left to go raises Contradiction.
+    """
+    __slots__ = ('puzzle', 'name', 'cells', 'position', 'counts', 'xors',
+                 'counted')
+
+    @staticmethod
+    def add_to_puzzle(puzzle=None):
+        assert(puzzle is not None)
+        puzzle.strategies.append(CountingSinglePosition)
+
+        for cell_group in puzzle.cell_groups:
+            # Instances are kept alive by the listener lists of the cells.
+            CountingSinglePosition(cell_group, puzzle=puzzle)
+
+    def __init__(self, cell_group, puzzle=None):
+        """
+        counts[value] and xors[value] cover the cells which still have
+        the value as a candidate; counted[i] is the candidate mask of the
+        i'th cell of the group as far as the counts know it.  Values
+        placed in the group are dropped.
+        """
+        self.puzzle = puzzle
+        self.name = cell_group.name + ".CountingSinglePosition"
+        self.cells = list(cell_group.cells)   # make a copy
+        self.position = dict(
+            (cell.index, i) for i, cell in enumerate(self.cells))
+        self.counts = counts = {}
+        self.xors = xors = {}
+        self.counted = [cell.candidate_set.mask for cell in self.cells]
+        for i, cell in enumerate(self.cells):
+            if cell.value is not None:
+                continue
+            for value in cell.candidate_set:
+                if value in counts:
+                    counts[value] += 1
+                    xors[value] ^= i
+                else:
+                    counts[value] = 1
+                    xors[value] = i
+        for cell in self.cells:
+            if cell.value in counts:
+                del counts[cell.value]
+                del xors[cell.value]
+
+        for cell in self.cells:
+            cell.add_cell_candidate_removed_listener(self)
+            cell.add_cell_value_set_listener(self)
+
+        for value in list(counts):
+            if counts.get(value) == 1:
+                self._found_value(self.cells[xors[value]], value)
+
+    def __repr__(self):
+        return self.name
+
+    def _found_value(self, cell, value):
+        if tracer.enabled:
+            tracer.record('SinglePosition.found', self.name, cell.name, value)
+        if self.puzzle is not None:
+            self.puzzle.log_solution_step(
+                "SinglePosition for {} in {} {}".format(
+                    value, self.name, cell.name))
+        cell.set_value(value)
+
+    def _uncount(self, trail, value, position):
+        counts = self.counts
+        xors = self.xors
+        count = counts[value]
+        if trail is not None:
+            trail.append((_undo_store, counts, value, count))
+            trail.append((_undo_store, xors, value, xors[value]))
+        count -= 1
+        counts[value] = count
+        xors[value] ^= position
+        if count == 1:
             metrics.inc('SinglePosition.found')
-            self._found_value(iter(possible_cells).next(), value)
+            self._found_value(self.cells[xors[value]], value)
+        elif count == 0:
+            raise Contradiction(
+                "no cell left for {} in {}".format(value, self.name))
+
+    def on_value_set(self, cell, value):
+        trail = cell.trail
+        position = self.position[cell.index]
+        mask = self.counted[position]
+        if trail is not None:
+            trail.append((_undo_store, self.counted, position, mask))
+        self.counted[position] = 0
+
+        counts = self.counts
+        if value in counts:
+            if trail is not None:
+                trail.append((_undo_store, counts, value, counts[value]))
+                trail.append((_undo_store, self.xors, value,
+                              self.xors[value]))
+            del counts[value]
+            del self.xors[value]
+
+        # the cell's other candidates, cleared without notice
+        values = cell.candidate_set.alphabet.values
+        while mask:
+            bit = mask & -mask
+            mask ^= bit
+            other = values[bit.bit_length() - 1]
+            if other in counts:
+                self._uncount(trail, other, position)
 
+    def on_candidate_removed(self, cell, value):
+        if value not in self.counts:
+            metrics.inc('SinglePosition.miss2')
+            return
+        position = self.position[cell.index]
+        mask = self.counted[position]
+        bit = cell.candidate_set.alphabet.bit[value]
+        if not mask & bit:
+            return
+        if cell.trail is not None:
+            cell.trail.append((_undo_store, self.counted, position, mask))
+        self.counted[position] = mask ^ bit
+        self._uncount(cell.trail, value, position)
 
-class CandidateLines:
+
+class CandidateLines(object):
     """
     If the only candidates for a value in a box lie on a line (i.e.
     a row or column) within that box, eliminate the value from
     candidates of cells in other boxes on the same line.
     """
+    __slots__ = ('puzzle', 'box', 'name', 'positions', 'rows', 'cols')
 
     @staticmethod
     def add_to_puzzle(puzzle=None):
 
         logging.info("CandidateLines.add_to_puzzle() called")
         assert(puzzle is not None)
+        puzzle.strategies.append(CandidateLines)
         for box_group in puzzle.boxes:
-            # TODO wonder about GC
-            # dummy = CandidateLines(box_group, puzzle=puzzle)
-            print "not implemented yet"
+            # Instances are kept alive by the listener lists of the cells.
+            CandidateLines(box_group, puzzle=puzzle)
 
     def __repr__(self):
         return "CandidateLines." + self.name
 
     def __init__(self, box_cell_group, puzzle=None):
         """
-        Create a two way index:
-        - For every unknown value in the box, store the list of rows and
-          cols the value can be on.
-        - For each of those rows/cols, store the
-          list of cells within the box the value can be in.
+        Index, for every unknown value in the box, where in the box it
+        can still go, as bitsets:
+        - positions[value]: bit i for the i'th cell of the box, numbered
+          row by row as in Topology.box_position
+        - rows[value], cols[value]: bit i for the i'th row or column of
+          the box which still has a cell in positions[value]
+
+        A value whose rows (or cols) are down to one bit has been found
+        on that line.  Its bitset is then set to 0, as there is nothing
+        more to find.  Values placed in the box are dropped.
         """
         assert(puzzle is not None)
 
-        # Internal index is a nested dict and looks like this.
-        #
-        # index[cand]['row'][rownum]['cells'] = set of cells
-        # index[cand]['row'][rownum]['peers'] = set of cells
-        # index[cand]['col'][colnum]['cells'] = set of cells
-        # index[cand]['col'][colnum]['peers'] = set of cells
-        #
-        # For example, to show that the candidate value 1
-        # can be on row 0 in cells (0,0), (0,1) and (0,2)
-        # the data structure might look like this (only
-        # the top row is depicted).
-
-        # +--+    +---+     +-+
-        # |1 |--> |row|---> |0|---> (Cell00, Cell01, Cell02)
-        # +--+    +---+     +-+
-        # |2 |    |col|     |1|
-        # +--+    +---+     +-+
-        # |3 |              |2|
-        # +--+              +-+
-        # |. |
-        # |. |
-        # +--+
-
         self.puzzle = puzzle
-        self.index = {}
-        self.box_cell_group = box_cell_group
+        self.box = box_cell_group
         self.name = box_cell_group.name
-        logging.info("in CandidateLines.__init__(), self.name = %s", self.name)
+        topology = puzzle.topology
+        box_position = topology.box_position
 
+        self.positions = positions = {}
         for cell in box_cell_group.cells:
-            logging.info(
-                "in CandidateLines.__init__(), cell = %s[%s]",
-                repr(cell),
-                "".join(str(x) for x in sorted(cell.candidate_set))
-            )
-
-            # import pdb; pdb.set_trace()
-            for cand in cell.candidate_set:
-                if cand not in self.index:
-                    # Create empty row and col dicts.
-                    self.index[cand] = dict(row=dict(), col=dict())
-
-                def store_peers(line_num, line_type, get_peers_fn):
-                    lines = self.index[cand][line_type]
-                    if line_num not in lines:
-                        lines[line_num] = {
-                            'cells': set(),
-                            'peers': get_peers_fn(line_num)
-                            }
-                    lines[line_num]['cells'].add(cell)
-
-                store_peers(cell.row, 'row', box_cell_group.get_peers_in_row)
-                store_peers(cell.col, 'col', box_cell_group.get_peers_in_col)
-
+            bit = 1 << box_position[cell.index]
+            for value in cell.candidate_set:
+                positions[value] = positions.get(value, 0) | bit
             cell.add_cell_candidate_removed_listener(self)
             cell.add_cell_value_set_listener(self)
 
-        logging.debug(
-            "in CandidateLines.__init__(), index =\n%s",
-            pprint.pformat(self.index)
-        )
+        self.rows = {}
+        self.cols = {}
+        for value, bits in positions.items():
+            self.rows[value] = self._lines(bits, topology.box_row_bits)
+            self.cols[value] = self._lines(bits, topology.box_col_bits)
 
         # If any values have only 1 possible row or col within the box,
         # eliminate them from other boxes in the same row or col.
-        # import pdb; pdb.set_trace()
-        for cand in list(self.index):
-            # use list() here because we might del items as we go
-            if cand not in self.index:
-                # WOW, could have been deleted by something else
-                continue
-
-            for line_type in list(self.index[cand]):
-                if cand not in self.index:
-                    continue
-                else:
+        # Eliminating may place values, which changes the index.
+        for value in list(positions):
+            for lines in (self.rows, self.cols):
+                if value not in lines:
                     metrics.inc('CandidateLines.miss.cand_deleted1')
+                    continue
+                bits = lines[value]
+                if bits and bits & (bits - 1) == 0:
+                    self._found_line(value, lines, bits)
 
-                if len(self.index[cand][line_type]) == 1:
-                    # import pdb; pdb.set_trace()
-                    linenum, line = self.index[cand][line_type].popitem()
-                    for cell in line['peers']:
-                        if cand in cell.candidate_set:
-                            cell.remove_candidate(cand)
-                            metrics.inc('CandidateLines.remove_cand1')
-
-                    if cand in self.index:
-                        del self.index[cand][line_type]
-                    else:
-                        metrics.inc('CandidateLines.miss.cand_deleted2')
+    @staticmethod
+    def _lines(positions, line_bits):
+        """ Bitset of the lines of line_bits with any of positions. """
+        found = 0
+        for line, bits in enumerate(line_bits):
+            if positions & bits:
+                found |= 1 << line
+        return found
+
+    def _found_line(self, value, lines, bits):
+        """
+        value can only be on the one line of bits within the box, so
+        eliminate it from the rest of that line.  lines is self.rows or
+        self.cols.
+        """
+        if self.puzzle.trail is not None:
+            self.puzzle.trail.append((_undo_store, lines, value, bits))
+        lines[value] = 0
+        topology = self.puzzle.topology
+        line = bits.bit_length() - 1
+        if lines is self.rows:
+            line_type = 'row'
+            line_num = self.box.boxrow + line
+            peers = topology.box_row_peers[self.box.number][line_num]
+        else:
+            line_type = 'col'
+            line_num = self.box.boxcol + line
+            peers = topology.box_col_peers[self.box.number][line_num]
+        if tracer.enabled:
+            tracer.record('CandidateLines.found', self.name,
+                          value, line_type, line_num)
+        cells = self.puzzle.cells
+        for i in peers:
+            peer_cell = cells[i]
+            if value in peer_cell.candidate_set:
+                peer_cell.remove_candidate(value)
+                metrics.inc('CandidateLines.remove_cand1')
+
+    def _remove_position(self, cell, value, lines, line, line_bits):
+        """
+        The cell's position in lines (self.rows or self.cols) has gone
+        from positions[value].  If that empties its line, which is line
+        of the box with bitset line_bits, drop the line, and check
+        whether one line is left.
+        """
+        if self.positions[value] & line_bits:
+            return
+        bits = lines[value]
+        line_bit = 1 << line
+        if not bits & line_bit:
+            return
+        if cell.trail is not None:
+            cell.trail.append((_undo_store, lines, value, bits))
+        bits ^= line_bit
+        lines[value] = bits
+        if bits and bits & (bits - 1) == 0:
+            self._found_line(value, lines, bits)
+
+    def _remove(self, cell, value):
+        """
+        Remove the cell from the positions of value, then look for a
+        CandidateLines condition on its row and column.
+        """
+        positions = self.positions
+        bits = positions.get(value)
+        if bits is None:
+            metrics.inc('CandidateLines.miss.cand3')
+            return
+        topology = self.puzzle.topology
+        position = topology.box_position[cell.index]
+        bit = 1 << position
+        if not bits & bit:
+            return
+        if cell.trail is not None:
+            cell.trail.append((_undo_store, positions, value, bits))
+        positions[value] = bits ^ bit
+
+        box_width = topology.box_width
+        col = position % box_width
+        self._remove_position(cell, value, self.cols, col,
+                              topology.box_col_bits[col])
+        if value not in positions:
+            return  # placed by the elimination
+        row = position // box_width
+        self._remove_position(cell, value, self.rows, row,
+                              topology.box_row_bits[row])
 
     def on_value_set(self, cell, value):
         """
-        Delete all references to the cell and the value within the index.
-        Each time the cell is deleted, use check_line() to
-        see if a new CandidateLine condition has been found.
+        Drop the value from the index, and the cell from the positions
+        of every other value.
         """
+        if value in self.positions:
+            trail = cell.trail
+            for index in (self.positions, self.rows, self.cols):
+                if trail is not None:
+                    trail.append((_undo_store, index, value, index[value]))
+                del index[value]
 
-        logging.info("CandidateLines.on_value_set()")
-        logging.info("  %s cell=%s, value=%s", self.name, repr(cell), value)
+        for cand_value in list(self.positions):
+            if cand_value in self.positions:
+                self._remove(cell, cand_value)
 
-        if value in self.index:
-            del self.index[value]
+    def on_candidate_removed(self, cell, value):
+        """
+        Remove the changed cell from the positions of the removed value.
+        """
+        if value in self.positions:
+            self._remove(cell, value)
 
-        logging.info("  index =\n%s", pprint.pformat(self.index))
 
-        # import pdb; pdb.set_trace()
-        # Delete this cell from the index.
-        for cand_value in list(self.index):
-            def del_from_index(line_type, line_num):
-                if cand_value not in self.index:
-                    metrics.inc('CandidateLines.miss.cand3')
-                    return
-
-                if line_type not in self.index[cand_value]:
-                    metrics.inc('CandidateLines.miss.line_type_deleted')
-                    return
-
-                lines = self.index[cand_value][line_type]
-
-                if line_num not in lines:
-                    # assume overlapping condition deleted it
-                    metrics.inc('CandidateLines.miss.line_deleted')
-                    return
-
-                #    import pdb; pdb.set_trace()
-
-                if cell in lines[line_num]['cells']:
-                    lines[line_num]['cells'].remove(cell)
-                    self.check_line(cand_value, line_type, line_num)
-            del_from_index('row', cell.row)
-            del_from_index('col', cell.col)
-
-        logging.info(
-            "in CandidateLines.on_value_set(),"
-            "modified index =\n%s",
-            pprint.pformat(self.index)
+class Topology(object):
+    """
+    The geometry of a grid with a given box width: the row, column and
+    box of every cell, each cell's peers, and where boxes and lines
+    intersect.  Cells are numbered row by row, so the cell at (row, col)
+    has index row * size + col.  Boxes are numbered the same way.
+
+    Computed once per box width and shared by every grid of that width;
+    use Topology.get().
+    """
+    _topologies = {}
+
+    @classmethod
+    def get(cls, box_width):
+        if box_width not in cls._topologies:
+            cls._topologies[box_width] = cls(box_width)
+        return cls._topologies[box_width]
+
+    def __init__(self, box_width):
+        self.box_width = box_width
+        self.size = size = box_width ** 2
+        self.num_cells = num_cells = size * size
+        indexes = range(num_cells)
+
+        self.row_of = tuple(i // size for i in indexes)
+        self.col_of = tuple(i % size for i in indexes)
+        self.box_of = tuple(
+            (self.row_of[i] // box_width) * box_width +
+            self.col_of[i] // box_width
+            for i in indexes
         )
 
-    def check_line(self, value, line_type, line_num):
-        """
-        If there is only one line within the box that a value
-        can be on, remove the value
-        from the candidates of all peers on the line.
-        """
+        # cell indexes of each group
+        self.rows = tuple(
+            tuple(range(row * size, (row + 1) * size)) for row in range(size)
+        )
+        self.cols = tuple(
+            tuple(range(col, num_cells, size)) for col in range(size)
+        )
+        self.box_origins = tuple(
+            (boxrow, boxcol)
+            for boxrow in range(0, size, box_width)
+            for boxcol in range(0, size, box_width)
+        )
+        self.boxes = tuple(
+            tuple(
+                row * size + col
+                for row in range(boxrow, boxrow + box_width)
+                for col in range(boxcol, boxcol + box_width)
+            )
+            for boxrow, boxcol in self.box_origins
+        )
 
-        logging.info("  check_line %s %s for value %s",
-                     line_type, line_num, value)
-        if len(self.index[value][line_type][line_num]['cells']) == 0:
-            logging.info("    no more cells for value")
+        # all other cells sharing a group with each cell
+        self.peers = tuple(
+            frozenset(
+                self.rows[self.row_of[i]] + self.cols[self.col_of[i]] +
+                self.boxes[self.box_of[i]]
+            ).difference([i])
+            for i in indexes
+        )
 
-            del self.index[value][line_type][line_num]
+        # for each box, {line number: cells of that line outside the box}
+        # for the lines which cross the box
+        def line_peers(lines, line_of):
+            peers = []
+            for box in self.boxes:
+                crossing = sorted(set(line_of[i] for i in box))
+                peers.append(dict(
+                    (line, tuple(i for i in lines[line] if i not in box))
+                    for line in crossing
+                ))
+            return tuple(peers)
+        self.box_row_peers = line_peers(self.rows, self.row_of)
+        self.box_col_peers = line_peers(self.cols, self.col_of)
+
+        # each cell's position within its box, numbered row by row, and
+        # the positions of each row and column of a box as bitsets
+        self.box_position = tuple(
+            (self.row_of[i] % box_width) * box_width +
+            self.col_of[i] % box_width
+            for i in indexes
+        )
+        self.box_row_bits = tuple(
+            sum(1 << (line * box_width + i) for i in range(box_width))
+            for line in range(box_width)
+        )
+        self.box_col_bits = tuple(
+            sum(1 << (i * box_width + line) for i in range(box_width))
+            for line in range(box_width)
+        )
 
-            if len(self.index[value][line_type]) == 1:
-                linenum, line = self.index[value][line_type].popitem()
-                logging.info("    delete %s %s", line_type, linenum)
-                logging.info("    removing peers")
-                # import pdb; pdb.set_trace()
-                for peer_cell in line['peers']:
-                    if value in peer_cell.candidate_set:
-                        peer_cell.remove_candidate(value)
-                        metrics.inc('CandidateLines.remove_cand1')
-                if value in self.index:
-                    del self.index[value][line_type]
-                else:
-                    metrics.inc('CandidateLines.miss.cand4')
+    def index(self, row, col):
+        return row * self.size + col
 
-    def on_candidate_removed(self, cell, value):
-        """
-        Remove the changed cell from the set of cells on the same
-        row and column for the removed candiate value.
-        """
+    def __repr__(self):
+        return "Topology({})".format(self.box_width)
 
-        logging.info("CandidateLines.on_candidate_removed()")
-        logging.info("  %s cell=%s, value=%s", self.name, repr(cell), value)
 
-        if value in self.index:
+class PuzzleState(object):
+    """
+    The values and candidates of every cell of a puzzle, held as two flat
+    arrays indexed by cell number (see Topology):
+    - masks: each cell's candidates as a CandidateMask bit mask
+    - values: the alphabet index of each cell's value, or -1 if unset
+
+    Unlike the Cell objects, a state can be copied with one buffer copy
+    per array, so is a cheap way to save a position and restore it later
+    or send it to another process.  See Puzzle.save_state() and
+    Puzzle.restore_state().
+    """
 
-            logging.info("  value is in index")
+    def __init__(self, box_width, alphabet, masks=None, values=None):
+        self.topology = Topology.get(box_width)
+        self.alphabet = alphabet
+        num_cells = self.topology.num_cells
+        if masks is None:
+            masks = [alphabet.full_mask] * num_cells
+        if values is None:
+            values = [-1] * num_cells
+        self.masks = self._mask_array(masks)
+        self.values = array('h', values)
+
+    def _mask_array(self, masks):
+        """
+        An array of machine words if they are wide enough for the
+        alphabet (box widths up to 8 on 64 bit platforms), else a list of
+        Python ints.
+        """
+        if len(self.alphabet) <= array('L').itemsize * 8:
+            return array('L', masks)
+        return list(masks)
+
+    def copy(self):
+        other = PuzzleState.__new__(PuzzleState)
+        other.topology = self.topology
+        other.alphabet = self.alphabet
+        other.masks = self.masks[:]
+        other.values = self.values[:]
+        return other
+
+    def __getstate__(self):
+        # The topology and alphabet are shared; send just enough to find
+        # them again.
+        return (self.topology.box_width, self.alphabet.values,
+                self.masks, self.values)
+
+    def __setstate__(self, state):
+        box_width, values, self.masks, self.values = state
+        self.topology = Topology.get(box_width)
+        self.alphabet = Alphabet.get(values)
+
+    def get_value(self, row, col):
+        index = self.values[self.topology.index(row, col)]
+        if index < 0:
+            return None
+        return self.alphabet.values[index]
+
+    def get_candidates(self, row, col):
+        """ Candidate values of a cell, in alphabet order. """
+        mask = self.masks[self.topology.index(row, col)]
+        return [value for value in self.alphabet.values
+                if mask & self.alphabet.bit[value]]
 
-            def _remove_from_line(line_type, line_num):
-                if value not in self.index:
-                    return  # TODO count these
-                if line_type in self.index[value]:
-                    lines = self.index[value][line_type]
-                    if line_num in lines:
-                        logging.info(
-                            "  removing from cells for %s %s",
-                            line_type, line_num
-                        )
-                        lines[line_num]['cells'].remove(cell)
-                        self.check_line(value, line_type, line_num)
+    def __eq__(self, other):
+        return self.alphabet is other.alphabet and \
+            self.topology is other.topology and \
+            list(self.masks) == list(other.masks) and \
+            self.values == other.values
+
+    def __ne__(self, other):
+        return not self == other
 
-            _remove_from_line('col', cell.col)
-            _remove_from_line('row', cell.row)
+    __hash__ = None
 
 
 class Grid(object):
@@ -608,18 +1396,15 @@ class Grid(object):
 
     def __init__(self, box_width):
         """
-        Internally represented as a list of lists: [row][col]
+        Internally represented as a flat list, row by row, indexed as
+        described by Topology.
         Coords match Python list indicies and start at 0.
         """
 
-        self.grid = []
+        self.topology = Topology.get(box_width)
         self.numcols = self.numrows = box_width ** 2
         self.box_width = box_width
-        for rownum in range(self.numrows):
-            row = []
-            for colnum in range(self.numcols):
-                row.append(None)
-            self.grid.append(row)
+        self.cells = [None] * self.topology.num_cells
 
     def onload_check_single_candidates(self):
         """
@@ -627,48 +1412,39 @@ class Grid(object):
         Call cell.onload_check_single_candidate() for all grid cells.
         Used after candidates have been loaded from an external source.
         """
-        for row in self.grid:
-            for cell in row:
-                cell.onload_check_single_candidate()
+        for cell in self.cells:
+            cell.onload_check_single_candidate()
 
     def set_cell(self, row, col, cell):
-        self.grid[row][col] = cell
+        self.cells[row * self.numcols + col] = cell
 
     def get_cell(self, row, col):
-        return self.grid[row][col]
+        return self.cells[row * self.numcols + col]
 
     def get_row_cells(self, rownum):
         """
         Get all cells in a row.
         """
-        _row = []
-        for colnum in range(self.numcols):
-            _row.append(self.get_cell(rownum, colnum))
-        return _row
+        cells = self.cells
+        return [cells[i] for i in self.topology.rows[rownum]]
 
     def get_col_cells(self, colnum):
         """ Get all cells in a column.  """
-        _col = []
-        for rownum in range(self.numrows):
-            _col.append(self.get_cell(rownum, colnum))
-        return _col
+        cells = self.cells
+        return [cells[i] for i in self.topology.cols[colnum]]
 
     def get_all_cells(self):
         """ Return list of all cells """
-        from itertools import chain
-        # import pdb; pdb.set_trace()
-        return list(chain.from_iterable(self.grid))
+        return list(self.cells)
 
     def get_box_cells(self, rownum, colnum):
         """
         Expects coord of top left cell in box.
         """
-        _box = []
-        for boxrow in range(rownum, rownum + self.box_width):
-            for boxcol in range(colnum, colnum + self.box_width):
-                # import pdb; pdb.set_trace()
-                _box.append(self.get_cell(boxrow, boxcol))
-        return _box
+        topology = self.topology
+        cells = self.cells
+        box = topology.box_of[topology.index(rownum, colnum)]
+        return [cells[i] for i in topology.boxes[box]]
 
     def to_string(self):
         max_len = 3
@@ -687,7 +1463,7 @@ class Grid(object):
                     s += ' '
                 if cell.value is None:
                     s += ''.join(
-                        str(x) for x in sorted(cell.candidate_set)
+                        str(x) for x in cell.candidate_set
                     ).center(max_len, ' ')
                 else:
                     s += str(cell.value).center(max_len, ' ')
@@ -716,51 +1492,69 @@ class Box(CellGroup):
     'Peers' are cells in the specified line but outside
     of this box.
     """
+    __slots__ = ('puzzle', 'boxrow', 'boxcol', 'number')
+
     def __init__(self, cells, puzzle=None, boxrow=0, boxcol=0):
         """
         boxrow and boxcol address the top left cell in the box.
         The box name will encode the same.
         """
         assert(puzzle is not None)
-        super(Box, self).__init__(
-            cells=cells, name="Box" + str(boxrow) + str(boxcol)
-        )
+        if boxrow < 10 and boxcol < 10:
+            name = "Box{}{}".format(boxrow, boxcol)
+        else:
+            name = "Box{},{}".format(boxrow, boxcol)
+        super(Box, self).__init__(cells=cells, name=name)
         self.puzzle = puzzle
-        self.name = "Box" + str(boxrow) + str(boxcol)
         self.boxrow = boxrow
         self.boxcol = boxcol
+        topology = puzzle.topology
+        self.number = topology.box_of[topology.index(boxrow, boxcol)]
 
     def get_peers_in_col(self, col):
-        allrows = range(self.puzzle.numrows)
-        box_rows = range(self.boxrow, self.boxrow + self.puzzle.box_width)
-        peers = []
-        for row in set(allrows).difference(set(box_rows)):
-            peers.append(self.puzzle.get_cell(row, col))
-        return peers
+        cells = self.puzzle.cells
+        peers = self.puzzle.topology.box_col_peers[self.number][col]
+        return [cells[i] for i in peers]
 
     def get_peers_in_row(self, row):
-        allcols = range(self.puzzle.numcols)
-        box_cols = range(self.boxcol, self.boxcol + self.puzzle.box_width)
-        peers = []
-        for col in set(allcols).difference(set(box_cols)):
-            peers.append(self.puzzle.get_cell(row, col))
-        return peers
+        cells = self.puzzle.cells
+        peers = self.puzzle.topology.box_row_peers[self.number][row]
+        return [cells[i] for i in peers]
 
 
 class Puzzle(Grid):
 
-    def __init__(self, box_width):
+    def __init__(self, box_width, symbols=None):
+        """
+        symbols is a string of one character per value, in order;
+        the default is the start of SYMBOLS.  Cell values are the symbols
+        themselves, so any box width can be read and written with one
+        character per cell.
+        """
         self.solution_steps = []
+        self.strategies = []    # classes added with add_to_puzzle()
+        self.trail = None       # undo journal, once mark() is called
+        self.base_listeners = None  # see prototype()
+        # before building the Topology, which is slow for large widths
+        self.symbols = check_symbols(symbols, box_width ** 2)
         super(Puzzle, self).__init__(box_width)
+        self.alphabet = Alphabet.get(self.symbols)
         for rownum in range(self.numrows):
             for colnum in range(self.numcols):
                 super(Puzzle, self).set_cell(
-                    rownum, colnum, Cell([], row=rownum, col=colnum)
+                    rownum, colnum,
+                    Cell([], row=rownum, col=colnum, alphabet=self.alphabet,
+                         index=self.topology.index(rownum, colnum))
                 )
         self.init_all_candidates()
+        self.value_for_symbol = dict(zip(self.symbols, self.alphabet.values))
+        self.symbol_for_value = dict(zip(self.alphabet.values, self.symbols))
         self.cell_groups = []   # all cell groups
         self.boxes = []         # just the boxes, for convenience
         self.init_groups()
+        self.propagator = Propagator()
+        for cell in self.cells:
+            cell.propagator = self.propagator
 
     def clear_all_candidates(self):
         """
@@ -778,11 +1572,149 @@ class Puzzle(Grid):
         for rownum in range(self.numrows):
             for colnum in range(self.numcols):
                 super(Puzzle, self).get_cell(rownum, colnum).set_candidates(
-                    map(str, range(1, self.numrows + 1))
+                    self.alphabet.values
                 )
 
     def log_solution_step(self, string):
         self.solution_steps.append(string)
+        if self.trail is not None:
+            self.trail.append((_undo_append, self.solution_steps))
+
+    def mark(self):
+        """
+        Return a mark for undo_to().  The first call starts journaling
+        every change made through propagation (cell values and
+        candidates, strategy indexes and solution steps) so that it can
+        be undone in time proportional to the number of changes.
+
+        Changes which bypass propagation (loading candidates, adding
+        strategies) are not journaled, so must come before the first
+        mark().
+        """
+        if self.trail is None:
+            self.trail = []
+            for cell in self.cells:
+                cell.trail = self.trail
+        return len(self.trail)
+
+    def undo_to(self, mark):
+        """
+        Undo every change made since mark() returned mark.
+        """
+        trail = self.trail
+        for entry in reversed(trail[mark:]):
+            entry[0](*entry[1:])
+        del trail[mark:]
+
+    @classmethod
+    def prototype(cls, box_width, symbols=None):
+        """
+        Return an empty puzzle with UniqueConstraints added, which can be
+        loaded, given strategies, solved and then reset() for the next
+        puzzle.  See PuzzlePool.
+
+        Strategies are best added after loading, as usual: their indexes
+        are built from the givens' candidates at about the cost of
+        keeping them up to date while the givens are set.
+        """
+        puzzle = cls(box_width, symbols)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.base_listeners = [
+            (tuple(cell.cell_value_set_listeners),
+             tuple(cell.candidate_removed_listeners))
+            for cell in puzzle.cells
+        ]
+        puzzle.base_constraints = set(
+            listener for cell in puzzle.cells
+            for listener in cell.cell_value_set_listeners)
+        return puzzle
+
+    def reset(self):
+        """
+        Return a puzzle from prototype() to the empty grid, as it was
+        made: values, candidates, solution steps, the trail and any
+        strategies added since are dropped.  Takes time proportional to
+        the grid size, however much solving was done since.  The cells,
+        groups and UniqueConstraints are kept.
+        """
+        assert self.base_listeners is not None, "not made by prototype()"
+        full_mask = self.alphabet.full_mask
+        for cell, (value_set, candidate_removed) in zip(
+                self.cells, self.base_listeners):
+            cell.value = None
+            cell.candidate_set.mask = full_mask
+            cell.cell_value_set_listeners = list(value_set)
+            cell.candidate_removed_listeners = list(candidate_removed)
+            cell.trail = None
+        for constraint in self.base_constraints:
+            constraint.reset()
+        self.solution_steps = []
+        self.strategies[:] = [UniqueConstraints]
+        self.trail = None
+
+    def is_solved(self):
+        """
+        True if every cell has a value and no group repeats a value.
+        """
+        for cell_group in self.cell_groups:
+            values = set(cell.value for cell in cell_group.cells)
+            if None in values or len(values) != len(cell_group.cells):
+                return False
+        return True
+
+    def copy(self):
+        """
+        *BYPASSES* propagation.
+        Return a new puzzle with the same values, candidates and
+        strategies.  The strategies rebuild their indexes from the copied
+        candidates, so may make further progress.
+        """
+        other = Puzzle(self.box_width, self.symbols)
+        other.restore_state(self.save_state())
+        other.solution_steps = list(self.solution_steps)
+        for strategy in self.strategies:
+            strategy.add_to_puzzle(other)
+        return other
+
+    def save_state(self):
+        """
+        Return the cell values and candidates as a PuzzleState.
+        """
+        index = dict((v, i) for i, v in enumerate(self.alphabet.values))
+        return PuzzleState(
+            self.box_width, self.alphabet,
+            masks=[cell.candidate_set.mask for cell in self.cells],
+            values=[index.get(cell.value, -1) for cell in self.cells],
+        )
+
+    def restore_state(self, state):
+        """
+        *BYPASSES* propagation.
+        Set the cell values and candidates from a PuzzleState.
+        Strategies build their indexes from the candidates when added,
+        so restore the state before adding them.  Not journaled; see
+        mark().
+        A puzzle from prototype() brings its UniqueConstraints up to date,
+        so raises Contradiction if a group repeats a value.
+        """
+        assert state.topology is self.topology
+        values = self.alphabet.values
+        for cell, mask, value in zip(self.cells, state.masks, state.values):
+            cell.value = values[value] if value >= 0 else None
+            cell.candidate_set.mask = int(mask)
+        if self.base_listeners is not None:
+            for constraint in self.base_constraints:
+                constraint.reset()
+
+    def count_solutions(self, limit=2, time_limit=None):
+        """
+        Number of solutions, counting no further than limit (None for
+        all), so the default answers whether the solution is unique.
+        Each guess is propagated by the strategies already added, so add
+        them first.  The puzzle is left as it was.  Raises SearchTimeout
+        after time_limit seconds.
+        """
+        return Search(time_limit=time_limit).count_solutions(self, limit)
 
     def init_groups(self):
         """
@@ -831,10 +1763,8 @@ class Puzzle(Grid):
         logging.info("load_from_iterable() called")
         _row = 0
         for _line in iterable:
-            import re
-
             # support script style comments with '#'
-            re.sub(r"#.*$", '', _line)  # strip them
+            _line = _line.split('#', 1)[0]
 
             _box_words = _line.split()
             _num_box_words = len(_box_words)
@@ -867,10 +1797,7 @@ class Puzzle(Grid):
                         )
                     )
 
-                import struct
-                _values = struct.unpack('c' * self.box_width, _word)
-
-                for _v in _values:
+                for _v in _word:
                     cell = super(Puzzle, self).get_cell(_row, _col)
                     if _v in cell.candidate_set:
                         metrics.inc('initially_given')
@@ -885,6 +1812,48 @@ class Puzzle(Grid):
     def load_from_string(self, string):
         self.load_from_iterable(iter(string.splitlines()))
 
+    def load_from_line(self, line):
+        """
+        Load givens from a single line with one character per cell, row
+        by row.  Values are the puzzle's symbols and unknown cells are any
+        of BLANKS, e.g. for a 4x4 puzzle:
+            12..34..........
+        Givens are set in one pass, so they propagate as they are loaded;
+        a given which breaks an earlier one raises Contradiction.
+        """
+        line = line.strip()
+        if len(line) != len(self.cells):
+            raise PuzzleParseError(
+                'expected {} characters, found {}'.format(
+                    len(self.cells), len(line)))
+
+        value_for_symbol = self.value_for_symbol
+        cells = self.cells
+        for index, char in enumerate(line):
+            value = value_for_symbol.get(char)
+            if value is not None:
+                cell = cells[index]
+                if cell.value is not None and cell.value != value:
+                    # already deduced from earlier givens
+                    raise Contradiction(
+                        "given {} for {} is not a candidate".format(
+                            value, cell.name))
+                cell.set_value(value)
+            elif char not in BLANKS:
+                raise PuzzleParseError(
+                    'invalid character "{}" at position {}'.format(
+                        char, index))
+
+    def to_line(self):
+        """
+        The puzzle as read by load_from_line(), with '.' for unknown cells.
+        """
+        symbol_for_value = self.symbol_for_value
+        return ''.join(
+            '.' if cell.value is None else symbol_for_value[cell.value]
+            for cell in self.cells
+        )
+
     def load_from_file(self, pathname):
         self.load_from_iterable(open(pathname))
 
@@ -910,6 +1879,8 @@ class Puzzle(Grid):
           *must* appear in the correct position in each character grid.
           E.g.  Row 1 = 123, row 2 = 456, row 3 is 789, and
           147 in column 1, 258 in column 2 and 369 in column 3.
+          Larger grids carry on with the puzzle's symbols, e.g. 1234,
+          5678, 9ABC, DEFG for 16x16.
           A space in a candidate position indicates that candidate value
           is not present.
         - Vertically the cells are separated by a single space except
@@ -921,9 +1892,7 @@ class Puzzle(Grid):
         self.clear_all_candidates()
         _cell_row = 0
         _text_row = 0
-        # _valid_candidate_values = set(map(str, range(1, self.numrows + 1)))
         for _line in iterable:
-            import re
             logging.info("_line: %s", _line)
 
             # import pdb; pdb.set_trace()
@@ -949,9 +1918,10 @@ class Puzzle(Grid):
                     continue
 
                 _value = char
-                _expected_value = ((_text_row % char_width) * self.box_width) \
-                    + (_text_col % char_width) + 1
-                _expected_value = str(_expected_value)
+                _expected_value = self.alphabet.values[
+                    (_text_row % char_width) * self.box_width +
+                    _text_col % char_width
+                ]
 
                 if _value != _expected_value:
                     raise PuzzleParseError(
@@ -987,18 +1957,1625 @@ class PuzzleParseError(Exception):
     pass
 
 
+class SearchTimeout(Exception):
+    pass
+
+
+class Search(object):
+    """
+    Backtracking search, for when the strategies stall.
+
+    Branches on the unknown cell with the fewest candidates and lets the
+    strategies propagate each guess.  Backtracking undoes the guess using
+    the puzzle's trail (see Puzzle.mark()).  A guess which leads to a
+    Contradiction is abandoned.
+    """
+    def __init__(self, time_limit=None):
+        """
+        time_limit is in seconds; SearchTimeout is raised once exceeded.
+        """
+        self.time_limit = time_limit
+        self.nodes = 0
+        self.elapsed = 0.0
+
+    def solve(self, puzzle):
+        """
+        Solve the puzzle in place and return it, or return None if there
+        is no solution.  If there is no solution, or SearchTimeout is
+        raised, the puzzle is left as it was.
+        """
+        self.nodes = 0
+        start = time.time()
+        self.deadline = None
+        if self.time_limit is not None:
+            self.deadline = start + self.time_limit
+        mark = puzzle.mark()
+        solution = None
+        try:
+            solution = self._search(puzzle)
+            return solution
+        finally:
+            if solution is None:
+                puzzle.undo_to(mark)
+            self.elapsed = time.time() - start
+
+    def count_solutions(self, puzzle, limit=None):
+        """
+        Return the number of solutions, stopping once limit are found.
+        The puzzle is left as it was.
+        """
+        self.nodes = 0
+        start = time.time()
+        self.deadline = None
+        if self.time_limit is not None:
+            self.deadline = start + self.time_limit
+        mark = puzzle.mark()
+        try:
+            return self._count(puzzle, limit)
+        finally:
+            puzzle.undo_to(mark)
+            self.elapsed = time.time() - start
+
+    def _visit(self):
+        self.nodes += 1
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout(
+                "gave up after {} nodes".format(self.nodes))
+
+    def _count(self, puzzle, limit):
+        self._visit()
+        cell = self.choose_cell(puzzle)
+        if cell is None:
+            return 1 if puzzle.is_solved() else 0
+
+        found = 0
+        for value in list(cell.candidate_set):
+            mark = puzzle.mark()
+            try:
+                cell.set_value(value)
+            except Contradiction:
+                metrics.inc('Search.contradiction')
+                puzzle.undo_to(mark)
+                continue
+            if limit is None:
+                found += self._count(puzzle, None)
+            else:
+                found += self._count(puzzle, limit - found)
+            puzzle.undo_to(mark)
+            if limit is not None and found >= limit:
+                break
+        return found
+
+    def _search(self, puzzle):
+        self._visit()
+        cell = self.choose_cell(puzzle)
+        if cell is None:
+            if puzzle.is_solved():
+                return puzzle
+            return None
+
+        for value in list(cell.candidate_set):
+            mark = puzzle.mark()
+            try:
+                puzzle.log_solution_step(
+                    "Guess {} for {}".format(value, cell.name))
+                cell.set_value(value)
+            except Contradiction:
+                metrics.inc('Search.contradiction')
+                puzzle.undo_to(mark)
+                continue
+            solution = self._search(puzzle)
+            if solution is not None:
+                return solution
+            puzzle.undo_to(mark)
+        return None
+
+    @staticmethod
+    def choose_cell(puzzle):
+        """
+        Unknown cell with the fewest candidates, or None if all are known.
+        """
+        best = None
+        best_len = None
+        for cell in puzzle.cells:
+            if cell.value is None:
+                num_candidates = len(cell.candidate_set)
+                if best is None or num_candidates < best_len:
+                    best = cell
+                    best_len = num_candidates
+                    if num_candidates == 2:
+                        break
+        return best
+
+
+class DancingLinks(object):
+    """
+    Exact cover solver (Knuth's Algorithm X with dancing links), for a
+    guaranteed finish whatever the strategies could do.
+
+    Each row of the matrix places a value in a cell and covers four
+    columns: the cell, and the value in its row, column and box.  Only
+    the puzzle's current values and candidates get rows, so givens and
+    anything the strategies have already eliminated are respected.
+
+    Same interface as Search, so either can finish a puzzle.
+    """
+    def __init__(self, time_limit=None, rng=None):
+        """
+        time_limit is in seconds; SearchTimeout is raised once exceeded.
+        rng is an optional random.Random; if given, candidates are tried
+        in random order, e.g. to make random grids from empty puzzles.
+        """
+        self.time_limit = time_limit
+        self.rng = rng
+        self.nodes = 0
+        self.elapsed = 0.0
+
+    def solve(self, puzzle):
+        """
+        Solve the puzzle in place and return it, or return None (leaving
+        the puzzle as it was) if there is no solution.
+        """
+        start = time.time()
+        try:
+            for solution in self.solutions(puzzle, limit=1):
+                puzzle.log_solution_step("Solved by exact cover")
+                for cell, value in zip(puzzle.cells, solution):
+                    if cell.value is None:
+                        cell.set_value(value)
+                return puzzle
+            return None
+        finally:
+            self.elapsed = time.time() - start
+
+    def solutions(self, puzzle, limit=None):
+        """
+        Generate up to limit (default all) solutions of the puzzle, each
+        a list of values indexed by cell number.  The puzzle is not
+        changed.
+        """
+        self.nodes = 0
+        deadline = None
+        if self.time_limit is not None:
+            deadline = time.time() + self.time_limit
+
+        # The matrix is held as parallel lists of links, indexed by node.
+        # Node 0 is the root and nodes 1..num_columns are the column
+        # headers.
+        topology = puzzle.topology
+        size = topology.size
+        num_cells = topology.num_cells
+        num_columns = 4 * num_cells
+        left = range(-1, num_columns)
+        left[0] = num_columns
+        right = range(1, num_columns + 2)
+        right[num_columns] = 0
+        up = range(num_columns + 1)
+        down = range(num_columns + 1)
+        column = range(num_columns + 1)
+        count = [0] * (num_columns + 1)
+        row_of = [None] * (num_columns + 1)     # (cell, value) per node
+
+        values = puzzle.alphabet.values
+        value_index = dict((value, i) for i, value in enumerate(values))
+        order = range(num_cells)
+        if self.rng is not None:
+            self.rng.shuffle(order)
+        for index in order:
+            cell = puzzle.cells[index]
+            if cell.value is not None:
+                candidates = [cell.value]
+            else:
+                candidates = list(cell.candidate_set)
+                if self.rng is not None:
+                    self.rng.shuffle(candidates)
+            # first column of the cell's row, column and box constraints
+            row_base = 1 + num_cells + size * topology.row_of[index]
+            col_base = 1 + 2 * num_cells + size * topology.col_of[index]
+            box_base = 1 + 3 * num_cells + size * topology.box_of[index]
+            for value in candidates:
+                v = value_index[value]
+                first = len(column)
+                for col in (1 + index, row_base + v, col_base + v,
+                            box_base + v):
+                    node = len(column)
+                    column.append(col)
+                    row_of.append((index, value))
+                    left.append(node - 1)
+                    right.append(node + 1)
+                    up.append(up[col])
+                    down.append(col)
+                    down[up[col]] = node
+                    up[col] = node
+                    count[col] += 1
+                left[first] = first + 3
+                right[first + 3] = first
+
+        def cover(col):
+            right[left[col]] = right[col]
+            left[right[col]] = left[col]
+            i = down[col]
+            while i != col:
+                j = right[i]
+                while j != i:
+                    down[up[j]] = down[j]
+                    up[down[j]] = up[j]
+                    count[column[j]] -= 1
+                    j = right[j]
+                i = down[i]
+
+        def uncover(col):
+            i = up[col]
+            while i != col:
+                j = left[i]
+                while j != i:
+                    count[column[j]] += 1
+                    down[up[j]] = j
+                    up[down[j]] = j
+                    j = left[j]
+                i = up[i]
+            right[left[col]] = col
+            left[right[col]] = col
+
+        def choose_column():
+            """ Column with the fewest rows, or None if all are covered. """
+            best = None
+            col = right[0]
+            while col != 0:
+                if best is None or count[col] < count[best]:
+                    best = col
+                    if count[col] <= 1:
+                        break
+                col = right[col]
+            return best
+
+        # Iterative, as the depth is the number of cells, which is past
+        # the recursion limit for large grids.
+        stack = []      # row node chosen at each depth
+        found = 0
+        descend = True
+        while True:
+            if descend:
+                self.nodes += 1
+                if deadline is not None and time.time() > deadline:
+                    raise SearchTimeout(
+                        "gave up after {} nodes".format(self.nodes))
+                col = choose_column()
+                if col is None:
+                    solution = [None] * num_cells
+                    for node in stack:
+                        index, value = row_of[node]
+                        solution[index] = value
+                    yield solution
+                    found += 1
+                    if limit is not None and found >= limit:
+                        return
+                elif count[col] > 0:
+                    cover(col)
+                    node = down[col]
+                    stack.append(node)
+                    j = right[node]
+                    while j != node:
+                        cover(column[j])
+                        j = right[j]
+                    continue
+
+            # backtrack to the next untried row
+            descend = False
+            while stack:
+                node = stack.pop()
+                j = left[node]
+                while j != node:
+                    uncover(column[j])
+                    j = left[j]
+                col = column[node]
+                node = down[node]
+                if node != col:
+                    stack.append(node)
+                    j = right[node]
+                    while j != node:
+                        cover(column[j])
+                        j = right[j]
+                    descend = True
+                    break
+                uncover(col)
+            if not descend:
+                return
+
+SEARCHES = {
+    'search': Search,
+    'dlx': DancingLinks,
+}
+
+# Strategies which can be chosen by name, e.g. by server requests.
+# UniqueConstraints is always used.
+STRATEGIES = {
+    'CandidateLines': CandidateLines,
+    'SinglePosition': SinglePosition,
+    'CountingSinglePosition': CountingSinglePosition,
+}
+DEFAULT_STRATEGIES = (CandidateLines, SinglePosition)
+
+
+class PuzzlePool(object):
+    """
+    Prototype puzzles (see Puzzle.prototype()) of one box width and
+    symbols, for solving many puzzles without building a new Puzzle for
+    each.  get() returns an empty puzzle, made only if none is free;
+    put() resets it and returns it to the pool.  Each process has its
+    own pools; see shared().
+    """
+    _shared = OrderedDict()
+    shared_maxsize = 8
+
+    @classmethod
+    def shared(cls, box_width=3, symbols=None):
+        """
+        The process's pool for a box width and symbols.  Only the
+        shared_maxsize most recently used are kept, since the symbols may
+        come from server requests.
+        """
+        key = (box_width, symbols)
+        pool = cls._shared.pop(key, None)
+        if pool is None:
+            pool = cls(box_width, symbols)
+            if len(cls._shared) >= cls.shared_maxsize:
+                cls._shared.popitem(last=False)
+        cls._shared[key] = pool
+        return pool
+
+    def __init__(self, box_width=3, symbols=None):
+        self.box_width = box_width
+        self.symbols = symbols
+        self.free = []
+
+    def get(self):
+        if self.free:
+            metrics.inc('PuzzlePool.reuse')
+            return self.free.pop()
+        metrics.inc('PuzzlePool.new')
+        return Puzzle.prototype(self.box_width, self.symbols)
+
+    def put(self, puzzle):
+        puzzle.reset()
+        self.free.append(puzzle)
+
+
+class SinglesBatch(object):
+    """
+    Naked and hidden singles (the logic of UniqueConstraints and
+    SinglePosition) for many puzzles at once, using NumPy array
+    operations rather than Cell objects.
+
+    The puzzles are held as an array of candidate masks of shape
+    (puzzles, cells); a cell is known when its mask has a single bit.
+    Each pass removes known values from their peers' candidates and
+    places every value which has only one possible cell in a row, column
+    or box, until nothing changes.  Puzzles which are left unfinished can
+    be handed on to the Puzzle strategies with to_state().
+
+    NumPy is only imported when an instance is created, so the rest of
+    the module does not need it.  Box widths up to 8.
+    """
+    def __init__(self, box_width=3, symbols=None):
+        import numpy
+        self.numpy = np = numpy
+        self.topology = topology = Topology.get(box_width)
+        size = topology.size
+        self.symbols = check_symbols(symbols, size)
+        self.alphabet = Alphabet.get(self.symbols)
+        for dtype in (np.uint16, np.uint32, np.uint64):
+            if np.dtype(dtype).itemsize * 8 >= size:
+                break
+        else:
+            raise ValueError("box width {} is too big".format(box_width))
+        self.dtype = dtype
+        self.zero = np.zeros((), dtype)
+        self.bits = np.array([1 << i for i in range(size)], dtype)
+        self.full_mask = np.bitwise_or.reduce(self.bits)
+
+        # cell indexes: rows, cols and boxes each cover every cell once
+        self.groups = [np.array(groups, np.intp) for groups in
+                       (topology.rows, topology.cols, topology.boxes)]
+        self.peers = np.array([sorted(peers) for peers in topology.peers],
+                              np.intp)
+
+        # character code: candidate mask, for parsing lines
+        self.mask_for_code = np.zeros(256, dtype)
+        self.valid_code = np.zeros(256, bool)
+        for symbol, bit in zip(self.symbols, self.bits):
+            self.mask_for_code[ord(symbol)] = bit
+            self.valid_code[ord(symbol)] = True
+        for blank in BLANKS:
+            self.mask_for_code[ord(blank)] = self.full_mask
+            self.valid_code[ord(blank)] = True
+        self.symbol_codes = np.array(map(ord, self.symbols), np.uint8)
+
+    def parse(self, lines):
+        """
+        Candidate masks for puzzles in the format read by
+        Puzzle.load_from_line(), all of which must be the right length.
+        Returns (masks, valid) where valid is False for any line with
+        characters which are not symbols or blanks.
+        """
+        np = self.numpy
+        codes = np.frombuffer(''.join(lines), np.uint8).reshape(
+            len(lines), self.topology.num_cells)
+        return self.mask_for_code[codes], self.valid_code[codes].all(axis=1)
+
+    def propagate(self, masks):
+        """
+        Apply singles to masks, in place, until nothing changes.
+        Returns an array which is True for each puzzle found to have no
+        solution.
+        """
+        np = self.numpy
+        zero = self.zero
+        bits = self.bits
+        dead = np.zeros(len(masks), bool)
+        active = np.arange(len(masks))
+        while len(active):
+            before = masks[active]
+            after = before.copy()
+            num = len(active)
+            failed = np.zeros(num, bool)
+
+            # naked singles: known values are not candidates of peers
+            known = (after & (after - 1)) == 0
+            placed = np.where(known, after, zero)
+            peer_values = np.bitwise_or.reduce(placed[:, self.peers], axis=2)
+            failed |= (placed & peer_values).any(axis=1)
+            after = np.where(known, after, after & ~peer_values)
+
+            # hidden singles: a value with one possible cell in a group
+            hidden = np.zeros_like(after)
+            for groups in self.groups:
+                has = (after[:, groups, None] & bits) != 0
+                counts = has.sum(axis=2)
+                failed |= (counts == 0).any(axis=(1, 2))
+                only = has & (counts == 1)[:, :, None, :]
+                found = np.bitwise_or.reduce(
+                    np.where(only, bits, zero), axis=3)
+                hidden[:, groups.ravel()] |= found.reshape(num, -1)
+            failed |= ((hidden & (hidden - 1)) != 0).any(axis=1)
+            after = np.where(hidden != 0, after & hidden, after)
+            failed |= (after == 0).any(axis=1)
+
+            masks[active] = after
+            dead[active] |= failed
+            changed = (after != before).any(axis=1)
+            active = active[changed & ~failed]
+        return dead
+
+    def is_solved(self, masks):
+        """ True for each puzzle with every cell known. """
+        return ((masks != 0) & ((masks & (masks - 1)) == 0)).all(axis=1)
+
+    def to_lines(self, masks):
+        """ Lines as written by Puzzle.to_line(). """
+        np = self.numpy
+        known = (masks != 0) & ((masks & (masks - 1)) == 0)
+        index = (masks[..., None] == self.bits).argmax(axis=-1)
+        codes = np.where(known, self.symbol_codes[index], ord('.'))
+        return [row.tobytes() for row in codes.astype(np.uint8)]
+
+    def to_state(self, cell_masks):
+        """
+        PuzzleState for one puzzle's masks, for solve_puzzle_state().
+        """
+        masks = []
+        values = []
+        for mask in cell_masks:
+            mask = int(mask)
+            if mask & (mask - 1) == 0:
+                masks.append(0)
+                values.append(mask.bit_length() - 1)
+            else:
+                masks.append(mask)
+                values.append(-1)
+        return PuzzleState(self.topology.box_width, self.alphabet,
+                           masks=masks, values=values)
+
+    _engines = OrderedDict()
+    engines_maxsize = 8
+
+    @classmethod
+    def get(cls, box_width, symbols=None):
+        """
+        Shared engine for a box width, to save rebuilding tables.  Only
+        the engines_maxsize most recently used are kept.
+        """
+        key = (box_width, symbols)
+        engine = cls._engines.pop(key, None)
+        if engine is None:
+            engine = cls(box_width, symbols)
+            if len(cls._engines) >= cls.engines_maxsize:
+                cls._engines.popitem(last=False)
+        cls._engines[key] = engine
+        return engine
+
+
+class Transform(object):
+    """
+    A symmetry of the grid: maybe transpose, then reorder the rows and
+    columns, then relabel the values.  Cell (row, col) of the result
+    comes from cell (rows[row], cols[col]) of the (transposed) original.
+    relabel maps every original symbol to its new one.
+    """
+    def __init__(self, size, transpose, rows, cols, relabel):
+        self.size = size
+        self.transpose = transpose
+        self.rows = rows
+        self.cols = cols
+        self.relabel = relabel
+        self.unlabel = dict((new, old) for old, new in relabel.items())
+        # index in the original line of each cell of the result
+        self.sources = []
+        for row in rows:
+            for col in cols:
+                if transpose:
+                    self.sources.append(col * size + row)
+                else:
+                    self.sources.append(row * size + col)
+
+    def apply(self, line):
+        """ Transform a line; unknown cells become '.'. """
+        relabel = self.relabel
+        return ''.join(relabel.get(line[source], '.')
+                       for source in self.sources)
+
+    def invert(self, line):
+        """ Undo apply(). """
+        result = ['.'] * len(line)
+        unlabel = self.unlabel
+        for char, source in zip(line, self.sources):
+            result[source] = unlabel.get(char, '.')
+        return ''.join(result)
+
+    def __repr__(self):
+        return "Transform(transpose={}, rows={}, cols={})".format(
+            self.transpose, self.rows, self.cols)
+
+
+def _line_orders(keys, box_width):
+    """
+    Orders of the rows (or columns) with the bands sorted by the keys of
+    their lines, and the lines in each band sorted by key.  Lines or
+    bands with equal keys may come in any order, so all of those orders
+    are generated.  Returns (count, generator).
+    """
+    from itertools import groupby, permutations, product
+
+    def tied_orders(items, key):
+        """ Orders of items sorted by key, ties in every order. """
+        groups = [list(group) for k, group in
+                  groupby(sorted(items, key=key, reverse=True), key)]
+        count = 1
+        for group in groups:
+            for n in range(2, len(group) + 1):
+                count *= n
+        orders = (
+            [item for part in parts for item in part]
+            for parts in product(*[permutations(group) for group in groups])
+        )
+        return count, orders
+
+    size = box_width ** 2
+    bands = [tuple(range(start, start + box_width))
+             for start in range(0, size, box_width)]
+    band_count, band_orders = tied_orders(
+        bands, lambda band: sorted((keys[i] for i in band), reverse=True))
+    count = band_count
+    line_orders = {}
+    for band in bands:
+        band_lines_count, orders = tied_orders(band, lambda i: keys[i])
+        count *= band_lines_count
+        line_orders[band] = list(orders)
+
+    def generate():
+        for band_order in band_orders:
+            for parts in product(*[line_orders[band] for band in band_order]):
+                yield [line for part in parts for line in part]
+    return count, generate()
+
+
+def canonical_form(line, box_width=3, symbols=None, max_orders=64):
+    """
+    Return (canonical, transform) for a puzzle line as read by
+    Puzzle.load_from_line(): puzzles which are the same up to relabelling
+    values, transposing, and reordering bands, stacks and the lines
+    within them have the same canonical line, and
+    transform.apply(line) == canonical.
+
+    The canonical line is the least, relabelling values by first
+    appearance, of the orders which sort rows and columns by invariants
+    of their givens.  Very symmetric puzzles have too many tied orders
+    to try; for those, if there are more than max_orders, return
+    (None, None).
+    """
+    size = box_width ** 2
+    symbols = check_symbols(symbols, size)
+    line = line.strip()
+    if len(line) != size * size:
+        raise PuzzleParseError('expected {} characters, found {}'.format(
+            size * size, len(line)))
+    for char in line:
+        if char not in symbols and char not in BLANKS:
+            raise PuzzleParseError('invalid character "{}"'.format(char))
+    value_count = dict((symbol, line.count(symbol)) for symbol in symbols)
+
+    candidates = []
+    total = 0
+    for transpose in (False, True):
+        if transpose:
+            grid = [line[col * size + row]
+                    for row in range(size) for col in range(size)]
+        else:
+            grid = line
+        rows = [grid[row * size:(row + 1) * size] for row in range(size)]
+        cols = [grid[col::size] for col in range(size)]
+        row_count = [sum(char in value_count for char in row) for row in rows]
+        col_count = [sum(char in value_count for char in col) for col in cols]
+
+        def key(cells, counts):
+            given = [i for i, char in enumerate(cells) if char in value_count]
+            return (len(given),
+                    sorted(counts[i] for i in given),
+                    sorted(value_count[cells[i]] for i in given))
+        row_keys = [key(row, col_count) for row in rows]
+        col_keys = [key(col, row_count) for col in cols]
+
+        num_row_orders, row_orders = _line_orders(row_keys, box_width)
+        num_col_orders, col_orders = _line_orders(col_keys, box_width)
+        total += num_row_orders * num_col_orders
+        if total > max_orders:
+            return None, None
+        candidates.append((transpose, grid, row_orders, list(col_orders)))
+
+    best = None
+    for transpose, grid, row_orders, col_orders in candidates:
+        for row_order in row_orders:
+            for col_order in col_orders:
+                labels = {}
+                chars = []
+                for row in row_order:
+                    base = row * size
+                    for col in col_order:
+                        char = grid[base + col]
+                        if char in value_count:
+                            if char not in labels:
+                                labels[char] = SYMBOLS[len(labels)]
+                            chars.append(labels[char])
+                        else:
+                            chars.append('.')
+                text = ''.join(chars)
+                if best is None or text < best[0]:
+                    best = (text, transpose, row_order, col_order, labels)
+
+    text, transpose, row_order, col_order, labels = best
+    # values which are not given take the remaining labels in order
+    unused = [label for label in SYMBOLS[:size]
+              if label not in labels.values()]
+    for symbol in symbols:
+        if symbol not in labels:
+            labels[symbol] = unused.pop(0)
+    return text, Transform(size, transpose, row_order, col_order, labels)
+
+
+class SolutionCache(object):
+    """
+    Solutions of puzzles keyed by canonical_form(), so that a puzzle
+    which is a relabelling, transposition or reordering of one already
+    solved is answered from the cache.  Puzzles too symmetric for
+    canonical_form() are keyed by their exact givens.
+
+    Holds up to maxsize solutions in memory, dropping the least recently
+    used.  With path, solutions are also kept in a shelve file there,
+    which outlives the process; a shelve file must not be shared by
+    processes writing at the same time.
+    """
+    def __init__(self, maxsize=10000, path=None):
+        from collections import OrderedDict
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.store = None
+        if path is not None:
+            import shelve
+            self.store = shelve.open(path)
+
+    def _key(self, line, box_width, symbols):
+        canonical, transform = canonical_form(line, box_width, symbols)
+        if canonical is None:
+            size = box_width ** 2
+            symbols = check_symbols(symbols, size)
+            line = line.strip()
+            transform = Transform(
+                size, False, range(size), range(size),
+                dict(zip(symbols, SYMBOLS[:size])))
+            canonical = '=' + transform.apply(line)
+        return '{}:{}'.format(box_width, canonical), transform
+
+    def get(self, line, box_width=3, symbols=None):
+        """
+        The solution of the puzzle in line, or None if not cached.
+        """
+        key, transform = self._key(line, box_width, symbols)
+        solution = self.entries.pop(key, None)
+        if solution is None and self.store is not None:
+            solution = self.store.get(key)
+        if solution is None:
+            metrics.inc('SolutionCache.miss')
+            return None
+        metrics.inc('SolutionCache.hit')
+        self._remember(key, solution)
+        return transform.invert(solution)
+
+    def put(self, line, solution, box_width=3, symbols=None):
+        key, transform = self._key(line, box_width, symbols)
+        canonical_solution = transform.apply(solution)
+        self.entries.pop(key, None)
+        self._remember(key, canonical_solution)
+        if self.store is not None:
+            self.store[key] = canonical_solution
+
+    def _remember(self, key, solution):
+        self.entries[key] = solution
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+    def __len__(self):
+        return len(self.entries)
+
+
+def iter_puzzle_texts(iterable, box_width=3):
+    """
+    Split a stream of many puzzles into one list of lines per puzzle,
+    lazily.  Each puzzle is either a single line as read by
+    Puzzle.load_from_line(), e.g. for a 9x9 puzzle:
+        .6.3..8.4537.9....4...63.7...
+    or the boxed layout read by Puzzle.load_from_iterable().  Blank lines
+    and comments starting with '#' are skipped.
+    A line is a boxed row only if it has box_width words; any other line
+    is a puzzle of its own, and ends a truncated boxed puzzle before it
+    so that the two fail or succeed apart.
+    """
+    numrows = box_width ** 2
+    rows = []
+    for line in iterable:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        if len(line.split()) != box_width:
+            if rows:
+                yield rows      # incomplete; will fail to parse
+                rows = []
+            yield [line]
+            continue
+        rows.append(line)
+        if len(rows) == numrows:
+            yield rows
+            rows = []
+    if rows:
+        yield rows      # incomplete; will fail to parse
+
+
+def solve_puzzle_text(lines, box_width=3, search=False, time_limit=None,
+                      symbols=None, cache=None, strategies=None, pool=None):
+    """
+    Parse and solve one puzzle from iter_puzzle_texts().
+    strategies are added after UniqueConstraints and loading; the
+    default is all of STRATEGIES.
+    With pool, a PuzzlePool of the same box width and symbols, the
+    puzzle is taken from the pool rather than built, and the caller
+    should put() it back once done with it.
+    If the strategies stall, search finishes the puzzle: it is True for
+    backtracking Search, or a name from SEARCHES.
+    With cache, a SolutionCache, one line puzzles are looked up before
+    solving and their solutions added after.
+    Returns (puzzle, status, nodes) where status is one of 'solved',
+    'unsolved' (strategies stalled), 'no_solution', 'timeout' or
+    'invalid'.  puzzle is None if it could not be parsed, as for a
+    boxed puzzle with too few rows.
+    """
+    if strategies is None:
+        strategies = DEFAULT_STRATEGIES
+    if cache is not None and len(lines) == 1:
+        return _solve_cached(cache, lines[0], box_width, search, time_limit,
+                             symbols, strategies, pool)
+    if pool is not None:
+        puzzle = pool.get()
+    else:
+        puzzle = Puzzle(box_width, symbols)
+    try:
+        if pool is None:
+            UniqueConstraints.add_to_puzzle(puzzle)
+        if len(lines) == 1:
+            puzzle.load_from_line(lines[0])
+        else:
+            numrows = sum(1 for line in lines if line.split('#', 1)[0].split())
+            if numrows < puzzle.numrows:
+                raise PuzzleParseError(
+                    'found {} rows, expected {}.'.format(
+                        numrows, puzzle.numrows))
+            puzzle.load_from_iterable(lines)
+        for strategy in strategies:
+            strategy.add_to_puzzle(puzzle)
+    except PuzzleParseError:
+        if pool is not None:
+            pool.put(puzzle)
+        return None, 'invalid', 0
+    except Contradiction:
+        return puzzle, 'no_solution', 0
+    except Exception:
+        if pool is not None:
+            pool.put(puzzle)
+        raise
+    try:
+        return _finish_puzzle(puzzle, search, time_limit)
+    except Exception:
+        if pool is not None:
+            pool.put(puzzle)
+        raise
+
+
+def _solve_cached(cache, line, box_width, search, time_limit, symbols,
+                  strategies, pool):
+    try:
+        solution = cache.get(line, box_width, symbols)
+    except PuzzleParseError:
+        return None, 'invalid', 0
+    if solution is not None:
+        if pool is not None:
+            puzzle = pool.get()
+        else:
+            puzzle = Puzzle(box_width, symbols)
+        puzzle.load_from_line(solution)
+        return puzzle, 'solved', 0
+    puzzle, status, nodes = solve_puzzle_text(
+        [line], box_width, search, time_limit, symbols,
+        strategies=strategies, pool=pool)
+    if status == 'solved':
+        cache.put(line, puzzle.to_line(), box_width, symbols)
+    return puzzle, status, nodes
+
+
+def solve_puzzle_state(state, search=False, time_limit=None, pool=None):
+    """
+    As solve_puzzle_text(), but starting from a PuzzleState, such as an
+    unfinished puzzle from SinglesBatch.
+    """
+    if pool is not None:
+        puzzle = pool.get()
+    else:
+        puzzle = Puzzle(state.topology.box_width,
+                        ''.join(state.alphabet.values))
+    try:
+        puzzle.restore_state(state)
+        if pool is None:
+            UniqueConstraints.add_to_puzzle(puzzle)
+        for strategy in DEFAULT_STRATEGIES:
+            strategy.add_to_puzzle(puzzle)
+    except Contradiction:
+        return puzzle, 'no_solution', 0
+    except Exception:
+        if pool is not None:
+            pool.put(puzzle)
+        raise
+    try:
+        return _finish_puzzle(puzzle, search, time_limit)
+    except Exception:
+        if pool is not None:
+            pool.put(puzzle)
+        raise
+
+
+def _finish_puzzle(puzzle, search, time_limit):
+    if puzzle.is_solved():
+        return puzzle, 'solved', 0
+    if not search:
+        return puzzle, 'unsolved', 0
+
+    if search is True:
+        search = 'search'
+    searcher = SEARCHES[search](time_limit=time_limit)
+    try:
+        solution = searcher.solve(puzzle)
+    except SearchTimeout:
+        return puzzle, 'timeout', searcher.nodes
+    if solution is None:
+        return puzzle, 'no_solution', searcher.nodes
+    return solution, 'solved', searcher.nodes
+
+
+# SolutionCache for solve_batch(); each worker process has its own copy.
+_batch_cache = None
+
+
+def _solve_batch_item(item):
+    """
+    Solve one puzzle from iter_puzzle_texts() and format the output lines.
+    Runs in a worker process with --jobs, so it takes a single picklable
+    argument and returns the metrics counted while solving, rather than
+    leaving them in this process's global metrics.
+    """
+    text, item_metrics, result = _solve_batch_puzzle(*item)
+    return text, item_metrics
+
+
+def _solve_batch_puzzle(number, lines, box_width, search, time_limit,
+                        symbols):
+    """
+    As _solve_batch_item(), also returning (solution, status, steps) for
+    the ResultStore, or None if the puzzle could not be parsed.
+
+    Puzzles come from a PuzzlePool, so building one costs a reset()
+    rather than a new Puzzle and strategies.
+    """
+    saved = metrics.to_dict()
+    metrics.clear()
+    pool = PuzzlePool.shared(box_width, symbols)
+    puzzle = None
+    try:
+        start = time.time()
+        puzzle, status, nodes = solve_puzzle_text(
+            lines, box_width, search=search, time_limit=time_limit,
+            symbols=symbols, cache=_batch_cache, pool=pool)
+        elapsed = time.time() - start
+        result = None
+        line = ''
+        if puzzle is not None:
+            line = puzzle.to_line()
+            result = (line, status, summarise_steps(puzzle.solution_steps))
+        text = _format_batch_result(number, line, status, elapsed, nodes)
+        return text, metrics.to_dict(), result
+    finally:
+        if puzzle is not None:
+            pool.put(puzzle)
+        metrics.clear()
+        metrics.merge(saved)
+
+
+def _format_batch_result(number, line, status, elapsed, nodes):
+    metrics.observe('latency_us.' + status, elapsed * 1000000)
+    if nodes:
+        metrics.observe('search_nodes', nodes)
+    return '{}\n# puzzle {}: {} in {:.3f}ms, {} search nodes\n'.format(
+        line, number + 1, status, elapsed * 1000, nodes)
+
+
+def _solve_batch_block(block):
+    """
+    Like _solve_batch_item(), for a list of puzzles.  Returns a list of
+    (text, metrics).
+
+    With a ResultStore path, one line puzzles already in the store are
+    answered from it with one query, and the new results are added in
+    one transaction at the end.
+
+    With vectorize, singles are first applied to all of the remaining
+    one line puzzles at once with SinglesBatch.  Only those left
+    unfinished, and puzzles in the boxed layout, go through the Puzzle
+    strategies.  So do those SinglesBatch finds to have no solution,
+    from their givens, so that every result is as without vectorize.
+
+    Time taken by a query or by SinglesBatch is shared equally between
+    its puzzles.
+    """
+    items, box_width, search, time_limit, symbols, vectorize, path = block
+    results = {}
+    new_results = {}    # number: (solution, status, steps)
+    givens = dict((number, normalise_givens(lines[0]))
+                  for number, lines in items if len(lines) == 1)
+    store = None
+
+    saved = metrics.to_dict()
+    metrics.clear()
+    try:
+        if path is not None:
+            store = ResultStore.shared(path)
+            start = time.time()
+            found = store.lookup(set(givens.values()), box_width)
+            elapsed = (time.time() - start) / max(1, len(givens))
+            for number, key in givens.items():
+                if key in found:
+                    solution, status, steps = found[key]
+                    metrics.inc('ResultStore.hit')
+                    results[number] = (_format_batch_result(
+                        number, solution, status, elapsed, 0),
+                        metrics.to_dict())
+                    metrics.clear()
+
+        if vectorize:
+            engine = SinglesBatch.get(box_width, symbols)
+            num_cells = engine.topology.num_cells
+            vectorized = [(number, lines) for number, lines in items
+                          if number not in results and len(lines) == 1 and
+                          len(lines[0]) == num_cells]
+        else:
+            vectorized = []
+        if vectorized:
+            start = time.time()
+            masks, valid = engine.parse([lines[0] for n, lines in vectorized])
+            dead = engine.propagate(masks)
+            solved = engine.is_solved(masks) & ~dead
+            result_lines = engine.to_lines(masks)
+            elapsed = (time.time() - start) / len(vectorized)
+            for i, (number, text) in enumerate(vectorized):
+                line = result_lines[i]
+                if not valid[i]:
+                    status = 'invalid'
+                    line = ''
+                elif solved[i]:
+                    status = 'solved'
+                else:
+                    continue
+                metrics.inc('SinglesBatch.' + status)
+                results[number] = (_format_batch_result(
+                    number, line, status, elapsed, 0), metrics.to_dict())
+                new_results[number] = (line, status, {})
+                metrics.clear()
+
+        for i, (number, text) in enumerate(vectorized):
+            if number in results:
+                continue
+            start = time.time()
+            line = None
+            if _batch_cache is not None:
+                line = _batch_cache.get(text[0], box_width, symbols)
+            if line is not None:
+                status, nodes, steps = 'solved', 0, {}
+            else:
+                pool = PuzzlePool.shared(box_width, symbols)
+                if dead[i]:
+                    # Where a contradiction is found depends on the order
+                    # of deductions; start again from the givens so that
+                    # the result is as without vectorize.
+                    metrics.inc('SinglesBatch.no_solution')
+                    puzzle, status, nodes = solve_puzzle_text(
+                        text, box_width, search, time_limit, symbols,
+                        pool=pool)
+                else:
+                    puzzle, status, nodes = solve_puzzle_state(
+                        engine.to_state(masks[i]), search, time_limit, pool)
+                line = puzzle.to_line()
+                steps = summarise_steps(puzzle.solution_steps)
+                pool.put(puzzle)
+                if status == 'solved' and _batch_cache is not None:
+                    _batch_cache.put(text[0], line, box_width, symbols)
+            elapsed = time.time() - start
+            results[number] = (_format_batch_result(
+                number, line, status, elapsed, nodes), metrics.to_dict())
+            new_results[number] = (line, status, steps)
+            metrics.clear()
+    finally:
+        metrics.clear()
+        metrics.merge(saved)
+
+    for number, lines in items:
+        if number not in results:
+            text, item_metrics, result = _solve_batch_puzzle(
+                number, lines, box_width, search, time_limit, symbols)
+            results[number] = (text, item_metrics)
+            if result is not None:
+                new_results[number] = result
+
+    if store is not None:
+        store.insert(
+            [(givens[number],) + result
+             for number, result in new_results.items()
+             if number in givens and result[1] in ResultStore.STATUSES],
+            box_width)
+    return [results[number] for number, lines in items]
+
+
+def solve_batch(iterable, out, box_width=3, search=False, time_limit=None,
+                jobs=1, chunksize=16, ordered=True, vectorize=False,
+                symbols=None, cache=None, store=None):
+    """
+    Solve every puzzle in iterable, one at a time, writing each result to
+    out as a line from Puzzle.to_line(), followed by a status comment
+    line.
+
+    With jobs > 1, puzzles are sent to a pool of worker processes in
+    chunks.  Results are written in input order unless ordered is False,
+    in which case they are written as they complete.  Either way, the
+    workers' metrics are merged into the global metrics.
+
+    With vectorize, each chunk is first run through SinglesBatch (which
+    needs NumPy), so larger chunks pay off.
+
+    With cache, a SolutionCache, puzzles which reach the Puzzle
+    strategies are looked up in it first; with vectorize, that is those
+    which SinglesBatch leaves unfinished.  Worker processes each start
+    with a copy of it, so a cache with a shelve file needs jobs=1.
+
+    With store, the path of a ResultStore, each chunk is looked up in
+    the store before solving and its new results added after.  Worker
+    processes share the store.
+    """
+    global _batch_cache
+    if cache is not None and cache.store is not None and jobs > 1:
+        raise ValueError("a SolutionCache file can't be shared by --jobs")
+    puzzles = enumerate(iter_puzzle_texts(iterable, box_width))
+    if vectorize or store is not None:
+        function = _solve_batch_block
+        items = (
+            (block, box_width, search, time_limit, symbols, vectorize, store)
+            for block in _iter_blocks(puzzles, chunksize)
+        )
+        chunksize = 1
+    else:
+        function = _solve_batch_item
+        items = (
+            (number, lines, box_width, search, time_limit, symbols)
+            for number, lines in puzzles
+        )
+
+    pool = None
+    _batch_cache = cache
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs)
+        if ordered:
+            results = pool.imap(function, items, chunksize)
+        else:
+            results = pool.imap_unordered(function, items, chunksize)
+    else:
+        results = (function(item) for item in items)
+    if function is _solve_batch_block:
+        results = (result for block in results for result in block)
+
+    try:
+        for text, item_metrics in results:
+            out.write(text)
+            metrics.merge(item_metrics)
+    finally:
+        _batch_cache = None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        ResultStore.close_shared()
+
+
+def normalise_givens(line):
+    """ A one line puzzle with every blank as '.'. """
+    return ''.join('.' if char in BLANKS else char for char in line.strip())
+
+
+def summarise_steps(steps):
+    """
+    Count solution steps (Puzzle.solution_steps) by kind, i.e. by their
+    first word, e.g. {'RemoveCandidate': 120, 'SinglePosition': 31}.
+    """
+    summary = {}
+    for step in steps:
+        kind = step.split(None, 1)[0]
+        summary[kind] = summary.get(kind, 0) + 1
+    return summary
+
+
+class ResultStore(object):
+    """
+    Results of solving puzzles, kept in an SQLite database: the solution,
+    status and summarise_steps() of each, keyed by box width and exact
+    givens (see normalise_givens()).
+
+    Lookups and inserts take many puzzles at a time.  The database is in
+    write-ahead log mode, so any number of processes can read it while
+    one writes; other writers wait up to timeout seconds for their turn.
+    Each process needs its own ResultStore; see shared().
+    """
+    # Results which don't depend on search options or time limits.
+    STATUSES = ('solved', 'no_solution')
+
+    _shared = {}
+
+    @classmethod
+    def shared(cls, path):
+        """
+        This process's ResultStore for path, opened on first use.
+        """
+        import os
+        key = (os.getpid(), path)
+        if key not in cls._shared:
+            cls._shared[key] = cls(path)
+        return cls._shared[key]
+
+    @classmethod
+    def close_shared(cls):
+        import os
+        for key in list(cls._shared):
+            if key[0] == os.getpid():
+                cls._shared.pop(key).close()
+
+    def __init__(self, path, timeout=30):
+        import sqlite3
+        self.connection = sqlite3.connect(path, timeout=timeout)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS results ('
+                ' box_width INTEGER NOT NULL,'
+                ' givens TEXT NOT NULL,'
+                ' solution TEXT NOT NULL,'
+                ' status TEXT NOT NULL,'
+                ' steps TEXT NOT NULL,'
+                ' PRIMARY KEY (box_width, givens))')
+
+    def lookup(self, givens, box_width=3):
+        """
+        Return {givens: (solution, status, steps)} for those of the
+        givens strings which are in the store.
+        """
+        import json
+        givens = list(givens)
+        found = {}
+        # SQLite allows 999 parameters by default
+        for start in range(0, len(givens), 500):
+            chunk = givens[start:start + 500]
+            rows = self.connection.execute(
+                'SELECT givens, solution, status, steps FROM results '
+                'WHERE box_width = ? AND givens IN ({})'.format(
+                    ','.join('?' * len(chunk))),
+                [box_width] + chunk)
+            for key, solution, status, steps in rows:
+                found[str(key)] = (str(solution), str(status),
+                                   json.loads(steps))
+        return found
+
+    def insert(self, results, box_width=3):
+        """
+        Add (givens, solution, status, steps) results in one transaction,
+        replacing any for the same givens.
+        """
+        import json
+        with self.connection:
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?)',
+                [(box_width, givens, solution, status,
+                  json.dumps(steps, sort_keys=True))
+                 for givens, solution, status, steps in results])
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM results').fetchone()[0]
+
+    def close(self):
+        self.connection.close()
+
+
+def _iter_blocks(iterable, size):
+    block = []
+    for item in iterable:
+        block.append(item)
+        if len(block) == size:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def _serve_request(request, max_time_limit=None):
+    """
+    Solve one server request, a dict decoded from JSON, in a worker
+    process.  Returns the response dict.  A request's time_limit is cut
+    to max_time_limit, which is also used if it gives none, null or a
+    time_limit that is not positive.
+    """
+    response = {'id': request.get('id')}
+    try:
+        text = request['puzzle']
+        if isinstance(text, basestring):
+            lines = [str(text)]
+        else:
+            lines = [str(line) for line in text]
+        strategies = request.get('strategies')
+        if strategies is not None:
+            strategies = [STRATEGIES[str(name)] for name in strategies]
+        symbols = request.get('symbols')
+        if symbols is not None:
+            symbols = str(symbols)
+        search = request.get('search', True)
+        if search not in (True, False):
+            search = str(search)
+            SEARCHES[search]
+        box_width = int(request.get('box_width', 3))
+        if not 1 <= box_width <= SERVER_MAX_BOX_WIDTH:
+            raise ValueError('box_width must be from 1 to {}'.format(
+                SERVER_MAX_BOX_WIDTH))
+        check_symbols(symbols, box_width ** 2)
+        time_limit = request.get('time_limit')
+        if time_limit is not None and (
+                isinstance(time_limit, bool) or
+                not isinstance(time_limit, (int, long, float))):
+            raise TypeError('time_limit must be a number of seconds')
+        if time_limit is None or time_limit <= 0:
+            time_limit = max_time_limit
+        elif max_time_limit is not None:
+            time_limit = min(time_limit, max_time_limit)
+        # check before taking a puzzle from the pool
+        pool = PuzzlePool.shared(box_width, symbols)
+        start = time.time()
+        puzzle, status, nodes = solve_puzzle_text(
+            lines, box_width, search=search, time_limit=time_limit,
+            symbols=symbols, strategies=strategies, pool=pool)
+        response['elapsed_ms'] = (time.time() - start) * 1000
+    except KeyError as e:
+        response['error'] = 'unknown or missing {}'.format(e)
+        return response
+    except (TypeError, ValueError) as e:
+        response['error'] = str(e)
+        return response
+    response['status'] = status
+    response['solution'] = None
+    if puzzle is not None:
+        response['solution'] = puzzle.to_line()
+        pool.put(puzzle)
+    response['nodes'] = nodes
+    return response
+
+
+def _warm_worker(box_widths):
+    """
+    Pool initializer: quieten the worker and solve a puzzle of each box
+    width, so that the modules, shared tables and code paths are ready
+    before the first request.
+    """
+    logging.getLogger().setLevel(logging.CRITICAL)
+    metrics.enabled = False
+    for box_width in box_widths:
+        size = box_width ** 2
+        pool = PuzzlePool.shared(box_width)
+        # Backtracking an empty grid takes too long past 16x16.
+        puzzle, status, nodes = solve_puzzle_text(
+            ['.' * (size * size)], box_width, search='dlx', time_limit=10,
+            pool=pool)
+        pool.put(puzzle)
+
+
+class _Ready(object):
+    """ A response known without asking the pool; see _SolveHandler. """
+    def __init__(self, response):
+        self.response = response
+
+    def get(self):
+        return self.response
+
+
+# Most seconds a server request may search for.
+SERVER_TIME_LIMIT = 10.0
+
+# Largest box width a server request may give; building the Topology for
+# much wider grids takes seconds and gigabytes.
+SERVER_MAX_BOX_WIDTH = 7
+
+
+def make_server(address, jobs=None, max_pending=None, box_widths=(3,),
+                time_limit=SERVER_TIME_LIMIT):
+    """
+    Return a server for serve_forever() which solves newline delimited
+    JSON requests, e.g.
+        {"id": 1, "puzzle": "4.....8.5.3...", "search": "dlx"}
+    Requests may also give "box_width" (at most SERVER_MAX_BOX_WIDTH),
+    "symbols", "time_limit" and "strategies" (names from STRATEGIES);
+    search defaults to true.  Each gets a response line with its id and
+    the status, solution, search nodes and elapsed_ms from
+    solve_puzzle_text(), or an error.
+
+    address is a Unix socket path (containing '/') or [host:]port, with
+    host defaulting to localhost.  Requests are solved by a pool of jobs
+    worker processes (default: one per CPU), warmed up with a puzzle of
+    each of box_widths.  A client may send many requests without
+    waiting; responses come back in request order.  Once max_pending
+    requests (default: 4 per worker) are being solved, no more are read
+    from any client until one finishes.  Nor are more read from a client
+    with max_pending responses it has not yet been sent, so one that
+    stops reading holds up only itself.  Requests search for no more
+    than time_limit seconds (None for no limit), whatever time_limit
+    they give.
+    """
+    import multiprocessing
+    import threading
+
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if max_pending is None:
+        max_pending = 4 * jobs
+
+    if '/' in address:
+        import os
+        if os.path.exists(address):
+            os.remove(address)
+        base = SocketServer.UnixStreamServer
+        server_address = address
+    else:
+        host, port = 'localhost', address
+        if ':' in address:
+            host, port = address.rsplit(':', 1)
+        base = SocketServer.TCPServer
+        server_address = (host, int(port))
+
+    class Server(SocketServer.ThreadingMixIn, base):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def server_close(self):
+            base.server_close(self)
+            self.pool.terminate()
+            self.pool.join()
+            if base is SocketServer.UnixStreamServer:
+                import os
+                os.remove(self.server_address)
+
+    pool = multiprocessing.Pool(jobs, _warm_worker, (box_widths,))
+    try:
+        server = Server(server_address, _SolveHandler)
+    except Exception:
+        pool.terminate()
+        raise
+    server.pool = pool
+    server.slots = threading.BoundedSemaphore(max_pending)
+    server.max_pending = max_pending
+    server.time_limit = time_limit
+    return server
+
+
+class _SolveHandler(SocketServer.StreamRequestHandler):
+    """
+    Serves one connection: this thread reads requests and hands them
+    to the pool, and a writer thread sends the responses in order.
+    A request holds one of the server's slots while it is being solved,
+    and one of the connection's until its response is sent.
+    """
+    def handle(self):
+        import json
+        import Queue
+        import threading
+        pending = Queue.Queue()
+        unsent = threading.BoundedSemaphore(self.server.max_pending)
+        writer = threading.Thread(target=self.write_responses,
+                                  args=(pending, unsent))
+        writer.daemon = True
+        writer.start()
+        try:
+            for line in iter(self.rfile.readline, ''):
+                if not line.strip():
+                    continue
+                unsent.acquire()
+                try:
+                    request = json.loads(line)
+                    if not isinstance(request, dict):
+                        raise ValueError('request is not an object')
+                except ValueError as e:
+                    pending.put((None, _Ready({'error': str(e)})))
+                    continue
+                self.server.slots.acquire()
+                pending.put((request.get('id'), self.server.pool.apply_async(
+                    _serve_request, (request, self.server.time_limit),
+                    callback=self.solved)))
+        finally:
+            pending.put(None)
+            writer.join()
+
+    def solved(self, response):
+        """ Frees the server slot as soon as a worker has finished. """
+        self.server.slots.release()
+
+    def write_responses(self, pending, unsent):
+        import json
+        import socket
+        connected = True
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            request_id, result = item
+            try:
+                response = result.get()
+            except Exception as e:
+                # the pool only calls back on success
+                self.server.slots.release()
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            unsent.release()
+            response['id'] = request_id
+            if connected:
+                try:
+                    self.wfile.write(json.dumps(response) + '\n')
+                    self.wfile.flush()
+                except socket.error:
+                    connected = False   # carry on freeing slots
+
+
+def write_metrics(out, style):
+    if style == 'text':
+        out.write(metrics.to_string() + '\n')
+    elif style == 'json':
+        out.write(metrics.to_json() + '\n')
+
+
 def main():
 
     import argparse
 
     parser = argparse.ArgumentParser(description='Solve Sudoku puzzle.')
-    parser.add_argument('filename', nargs=1)
-    parser.add_argument('--boxwidth', default=3, help='box width in cells')
+    parser.add_argument('filename', nargs='?', help="puzzle file, or '-' for "
+                        "stdin with --batch")
+    parser.add_argument('--boxwidth', default=3, type=int,
+                        help='box width in cells')
+    parser.add_argument('--symbols', default=None,
+                        help='one character per value, in order (default '
+                             '1-9 then A-Z)')
+    parser.add_argument('--search', action='store_true',
+                        help='finish with backtracking search if the '
+                             'strategies stall')
+    parser.add_argument('--solver', choices=sorted(SEARCHES), default=None,
+                        help="how to finish: backtracking 'search' or "
+                             "exact cover 'dlx'; implies --search")
+    parser.add_argument('--time-limit', type=float, default=None,
+                        help='give up searching after this many seconds; '
+                             'with --serve, the most any request may give '
+                             '(default 10)')
+    parser.add_argument('--count-solutions', type=int, default=None,
+                        metavar='LIMIT',
+                        help='count solutions, stopping at LIMIT (2 checks '
+                             'the solution is unique; 0 counts them all)')
+    parser.add_argument('--batch', action='store_true',
+                        help='solve many puzzles, one per line or in the '
+                             'boxed layout, printing one result line each')
+    parser.add_argument('-j', '--jobs', type=int, default=None,
+                        help='number of worker processes for --batch '
+                             '(default 1) or --serve (default one per CPU)')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='instead of solving a file, serve JSON '
+                             'requests on a Unix socket path or '
+                             '[host:]port')
+    parser.add_argument('--max-pending', type=int, default=None,
+                        help='with --serve, requests solved at once before '
+                             'reading from clients stops (default 4 per '
+                             'worker)')
+    parser.add_argument('--chunksize', type=int, default=None,
+                        help='puzzles sent to a worker at a time '
+                             '(default 16, or 1024 with --numpy)')
+    parser.add_argument('--numpy', action='store_true',
+                        help='with --batch, apply singles to each chunk '
+                             'of puzzles at once with NumPy')
+    parser.add_argument('--unordered', action='store_true',
+                        help='with --jobs, write results as they complete '
+                             'rather than in input order')
+    parser.add_argument('--cache', type=int, default=0, metavar='SIZE',
+                        help='with --batch, remember up to SIZE solutions '
+                             'and reuse them for puzzles which are the same '
+                             'up to symmetry')
+    parser.add_argument('--cache-file', default=None, metavar='PATH',
+                        help='also keep cached solutions in this file')
+    parser.add_argument('--store', default=None, metavar='PATH',
+                        help='with --batch, look puzzles up in this SQLite '
+                             'result store and add new results to it')
     parser.add_argument('-v', '--verbose', action='count', default=0,
                         help='multiple times increases verbosity')
+    parser.add_argument('--metrics', choices=['text', 'json', 'none'],
+                        default='text',
+                        help="metrics report format; 'none' also turns off "
+                             "collecting them")
+    parser.add_argument('--timers', action='store_true',
+                        help='also time each strategy callback in the '
+                             'metrics (slows solving)')
+    parser.add_argument('--trace', type=int, default=0, metavar='EVENTS',
+                        help='keep the last EVENTS solver trace events and '
+                             'write them to stderr at exit (not recorded '
+                             'by --jobs workers)')
 
     args = parser.parse_args()
-    filename = args.filename[0]
+    filename = args.filename
+    if filename is None and not args.serve:
+        parser.error('a puzzle file is needed')
+    search = args.solver or args.search
     if args.verbose == 0:
         logging.getLogger().setLevel(logging.CRITICAL)
     elif args.verbose == 1:
@@ -1011,15 +3588,91 @@ def main():
     logging.basicConfig(format="%(message)s")
     # logging.getLogger().addHandler(logging.StreamHandler(sys.stdout)
 
-    puzzle = Puzzle(args.boxwidth)
+    import sys
+    if args.metrics == 'none':
+        metrics.enabled = False
+    elif args.timers:
+        metrics.timing = True
+
+    if args.trace > 0:
+        import atexit
+        tracer.enable(args.trace)
+        atexit.register(tracer.dump, sys.stderr)
+
+    if args.serve:
+        time_limit = SERVER_TIME_LIMIT
+        if args.time_limit is not None:
+            time_limit = args.time_limit
+        server = make_server(args.serve, args.jobs, args.max_pending,
+                             box_widths=(args.boxwidth,),
+                             time_limit=time_limit)
+        logging.info('serving on %s', args.serve)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return
+
+    if args.batch:
+        if filename == '-':
+            source = sys.stdin
+        else:
+            source = open(filename)
+        cache = None
+        if args.cache or args.cache_file:
+            cache = SolutionCache(args.cache or 10000, args.cache_file)
+        solve_batch(source, sys.stdout, args.boxwidth,
+                    search=search, time_limit=args.time_limit,
+                    jobs=args.jobs or 1,
+                    chunksize=args.chunksize or (1024 if args.numpy else 16),
+                    ordered=not args.unordered, vectorize=args.numpy,
+                    symbols=args.symbols, cache=cache, store=args.store)
+        if cache is not None:
+            cache.close()
+        write_metrics(sys.stderr, args.metrics)
+        return
+
+    puzzle = Puzzle(args.boxwidth, args.symbols)
 
     # TODO why can't UniqueConstraints be added after loading puzzle ?
     UniqueConstraints.add_to_puzzle(puzzle)
     puzzle.load_from_file(filename)
     CandidateLines.add_to_puzzle(puzzle)
     SinglePosition.add_to_puzzle(puzzle)
+
+    if args.count_solutions is not None:
+        limit = args.count_solutions or None
+        try:
+            found = puzzle.count_solutions(limit, args.time_limit)
+        except SearchTimeout as e:
+            print "Counting timed out: {}".format(e)
+        else:
+            if limit is not None and found >= limit:
+                print "At least {} solutions".format(found)
+            elif found == 1:
+                print "1 solution"
+            else:
+                print "{} solutions".format(found)
+
+    if search and not puzzle.is_solved():
+        searcher = SEARCHES[args.solver or 'search'](
+            time_limit=args.time_limit)
+        try:
+            solution = searcher.solve(puzzle)
+        except SearchTimeout as e:
+            print "Search timed out: {}".format(e)
+        else:
+            if solution is None:
+                print "No solution"
+            else:
+                puzzle = solution
+        print "Search explored {} nodes in {:.3f}s".format(
+            searcher.nodes, searcher.elapsed)
+
     print puzzle.to_string()
-    print metrics.to_string()
+    write_metrics(sys.stdout, args.metrics)
 
 if __name__ == '__main__':
     main()
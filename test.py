@@ -50,6 +50,36 @@ class TestCandidateSet(unittest.TestCase):
         self.assertRaises(KeyError, obj.remove_candidate, 3)
 
 
+class TestCandidateMask(unittest.TestCase):
+    def test_remove_candidate(self):
+        obj = CandidateMask([1, 3, 2])
+        obj.remove_candidate(2)
+        self.assertFalse(2 in obj)
+        self.assertTrue(1 in obj)
+        self.assertTrue(3 in obj)
+        self.assertEqual(len(obj), 2)
+
+    def test_remove_final_candidate(self):
+        obj = CandidateMask([1, 2])
+        self.assertRaises(SingleCandidate, obj.remove_candidate, 1)
+        self.assertTrue(obj.has_single_candidate())
+        self.assertEqual(obj.get_any_candidate(), 2)
+        self.assertRaises(AssertionError, obj.remove_candidate, 2)
+
+    def test_remove_KeyError_on_remove_element_not_there(self):
+        obj = CandidateMask([1, 2], alphabet=Alphabet.get([1, 2, 3]))
+        self.assertRaises(KeyError, obj.remove_candidate, 3)
+        self.assertRaises(KeyError, obj.remove_candidate, 4)
+
+    def test_shared_alphabet(self):
+        alphabet = Alphabet.get('1234')
+        self.assertTrue(alphabet is Alphabet.get(['1', '2', '3', '4']))
+        obj = CandidateMask('42', alphabet)
+        self.assertEqual(obj.mask, 0b1010)
+        self.assertEqual(list(obj), ['2', '4'])
+        self.assertEqual(obj, CandidateMask('24', alphabet))
+
+
 class TestCell(unittest.TestCase):
     def test_set_then_get(self):
         cell = Cell([1, 2, 3])
@@ -70,6 +100,26 @@ class TestCell(unittest.TestCase):
         self.assertTrue(1 in obj.candidate_set)
         self.assertTrue(3 in obj.candidate_set)
 
+    def test_add_candidate(self):
+        cell = Cell([])
+        cell.add_candidate('2')
+        cell.add_candidate('1')
+        self.assertEqual(list(cell.candidate_set), ['1', '2'])
+        cell.remove_candidate('2')
+        self.assertEqual(cell.value, '1')
+        puzzle = Puzzle(2)
+        self.assertRaisesRegexp(KeyError, "'5' is not a value",
+                                puzzle.get_cell(0, 0).add_candidate, '5')
+
+    def test_identity(self):
+        puzzle = Puzzle(4)
+        cell = puzzle.get_cell(1, 11)
+        self.assertEqual(cell.index, 27)
+        self.assertNotEqual(cell, puzzle.get_cell(11, 1))
+        self.assertEqual(len(set(puzzle.cells)), 256)
+        self.assertEqual(puzzle.copy().get_cell(1, 11), cell)
+        self.assertNotEqual(Cell([1]), Cell([1]))
+
 
 class TestUniqueConstraints(unittest.TestCase):
     def setUp(self):
@@ -112,6 +162,154 @@ class TestUniqueConstraints(unittest.TestCase):
         pass
 
 
+class TestCountingSinglePosition(unittest.TestCase):
+    def test_last_cell(self):
+        cells = [Cell(['1', '2', '3']) for i in range(3)]
+        CountingSinglePosition(CellGroup(cells))
+        cells[0].remove_candidate('3')
+        cells[2].remove_candidate('3')
+        self.assertEqual(cells[1].value, '3')
+
+    def test_set_cells_are_uncounted(self):
+        cells = [Cell(['1', '2', '3']) for i in range(3)]
+        CountingSinglePosition(CellGroup(cells))
+        cells[0].set_value('1')     # no UniqueConstraints
+        cells[1].remove_candidate('2')
+        self.assertEqual(cells[2].value, '2')
+        self.assertEqual(cells[1].value, '3')
+
+    def test_nowhere_left(self):
+        cells = [Cell(['1', '2', '3']) for i in range(2)]
+        CountingSinglePosition(CellGroup(cells))
+        self.assertRaises(Contradiction, cells[0].remove_candidate, '3')
+
+    def test_same_as_single_position(self):
+        puzzles = []
+        for strategy in (SinglePosition, CountingSinglePosition):
+            puzzle = Puzzle(2)
+            UniqueConstraints.add_to_puzzle(puzzle)
+            puzzle.load_from_line('1.......' '..1.....')
+            strategy.add_to_puzzle(puzzle)
+            puzzles.append(puzzle)
+        self.assertEqual(puzzles[1].get_cell(1, 3).value, '1')
+        self.assertEqual(puzzles[1].get_cell(3, 1).value, '1')
+        self.assertTrue(puzzles[1].is_equal_to(puzzles[0]))
+
+
+class TestPropagator(unittest.TestCase):
+    def test_queued_propagation(self):
+        cells = [Cell([1, 2, 3], row=0, col=col) for col in range(3)]
+        propagator = Propagator()
+        for cell in cells:
+            cell.propagator = propagator
+        dummy = UniqueConstraints(CellGroup(cells))
+        cells[0].set_value(1)
+        cells[1].set_value(2)
+        self.assertEqual([cell.value for cell in cells], [1, 2, 3])
+        self.assertFalse(propagator.running)
+
+    def test_queue_discarded_on_error(self):
+        puzzle = Puzzle(2)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.get_cell(0, 0).set_value('1')
+        self.assertRaises(AssertionError,
+                          puzzle.get_cell(0, 1).set_value, '1')
+        self.assertFalse(puzzle.propagator.assignments)
+        self.assertFalse(puzzle.propagator.removals)
+
+    def test_large_grid_bounded_stack(self):
+        import sys
+        puzzle = Puzzle(5)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        limit = sys.getrecursionlimit()
+        sys.setrecursionlimit(100)
+        try:
+            for col in range(puzzle.numcols - 1):
+                puzzle.get_cell(0, col).set_value(puzzle.symbols[col])
+        finally:
+            sys.setrecursionlimit(limit)
+        self.assertEqual(puzzle.get_cell(0, puzzle.numcols - 1).value,
+                         puzzle.symbols[-1])
+
+
+class TestMetrics(unittest.TestCase):
+    def test_histogram_and_merge(self):
+        first = Metrics()
+        first.inc('count')
+        first.observe('latency', 0)
+        first.observe('latency', 5)
+        first.observe('latency', 7)
+        first.add_time('timer', 0.5)
+        second = Metrics()
+        second.merge(first.to_dict())
+        second.merge(first.to_dict())
+        self.assertEqual(second.metrics, {'count': 2})
+        self.assertEqual(second.histograms, {'latency': {1: 2, 8: 4}})
+        self.assertEqual(second.timers, {'timer': [2, 1.0]})
+        import json
+        self.assertEqual(json.loads(second.to_json())['counters'],
+                         {'count': 2})
+
+    def test_disabled(self):
+        obj = Metrics(enabled=False)
+        obj.inc('count')
+        obj.observe('latency', 5)
+        obj.add_time('timer', 0.5)
+        self.assertEqual(obj.to_dict(),
+                         {'counters': {}, 'timers': {}, 'histograms': {}})
+
+    def test_strategy_credit(self):
+        saved = metrics.to_dict()
+        results = []
+        try:
+            for timing in (False, True):
+                metrics.clear()
+                metrics.timing = timing
+                puzzle = Puzzle(2)
+                UniqueConstraints.add_to_puzzle(puzzle)
+                puzzle.get_cell(0, 0).set_value('1')
+                results.append((metrics.metrics, metrics.timers))
+        finally:
+            metrics.timing = False
+            metrics.clear()
+            metrics.merge(saved)
+        for counts, timers in results:
+            self.assertEqual(counts['UniqueConstraints.eliminations'], 7)
+        self.assertEqual(results[0][1], {})
+        self.assertEqual(
+            results[1][1]['UniqueConstraints.on_value_set'][0], 3)
+
+
+class TestTracer(unittest.TestCase):
+    def test_disabled_tracer_records_nothing(self):
+        puzzle = Puzzle(2)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        count = tracer.count
+        puzzle.get_cell(0, 0).set_value('1')
+        self.assertEqual(tracer.count, count)
+
+    def test_ring_buffer(self):
+        from StringIO import StringIO
+        trace = Tracer(size=2)
+        for i in range(5):
+            trace.record('event', i)
+        out = StringIO()
+        trace.dump(out)
+        self.assertEqual(out.getvalue().splitlines(), [
+            '... 3 earlier events dropped', 'event 3', 'event 4'])
+
+    def test_enabled_tracer(self):
+        tracer.enable(100)
+        try:
+            tracer.events.clear()
+            cell = Cell(['1', '2'], row=0, col=0)
+            cell.set_value('2')
+        finally:
+            tracer.disable()
+        self.assertEqual(list(tracer.events), [('set_value', 'C00', '2')])
+
+
 class TestGrid(unittest.TestCase):
     def test_grid_rc(self):
         grid = Grid(2)
@@ -149,11 +347,123 @@ class TestGrid(unittest.TestCase):
         self.assertTrue(sum(box) == 10)
 
 
+class TestTopology(unittest.TestCase):
+    def test_shared(self):
+        self.assertIs(Topology.get(3), Topology.get(3))
+        self.assertIs(Puzzle(2).topology, Puzzle(2).topology)
+
+    def test_tables(self):
+        topology = Topology.get(2)
+        index = topology.index(1, 2)    # row 1, col 2: box 1
+        self.assertEqual(topology.row_of[index], 1)
+        self.assertEqual(topology.col_of[index], 2)
+        self.assertEqual(topology.box_of[index], 1)
+        self.assertEqual(topology.boxes[1], (2, 3, 6, 7))
+        self.assertEqual(topology.peers[index],
+                         frozenset([4, 5, 7, 2, 10, 14, 3]))
+        self.assertEqual(topology.box_row_peers[1], {0: (0, 1), 1: (4, 5)})
+        self.assertEqual(topology.box_col_peers[1], {2: (10, 14),
+                                                     3: (11, 15)})
+        self.assertEqual(topology.box_position[index], 2)
+        self.assertEqual(topology.box_row_bits, (0b0011, 0b1100))
+        self.assertEqual(topology.box_col_bits, (0b0101, 0b1010))
+
+    def test_box_peers(self):
+        puzzle = Puzzle(3)
+        box = puzzle.boxes[4]
+        self.assertEqual(
+            [cell.name for cell in box.get_peers_in_row(4)],
+            ['C40', 'C41', 'C42', 'C46', 'C47', 'C48'])
+        self.assertEqual(
+            [cell.name for cell in box.get_peers_in_col(3)],
+            ['C03', 'C13', 'C23', 'C63', 'C73', 'C83'])
+
+
 class TestPuzzle(unittest.TestCase):
     def test_puzzle_create(self):
         dummy = Puzzle(2)
 
 
+class TestPuzzleState(unittest.TestCase):
+    def test_save_and_restore(self):
+        import pickle
+        puzzle = Puzzle(2)
+        puzzle.load_from_line('1...' '..2.' '....' '...4')
+        state = puzzle.save_state()
+        self.assertEqual(state.get_value(0, 0), '1')
+        self.assertEqual(state.get_value(0, 1), None)
+        self.assertEqual(state.get_candidates(0, 1),
+                         list(puzzle.get_cell(0, 1).candidate_set))
+
+        copy = state.copy()
+        copy.values[1] = 2
+        self.assertNotEqual(copy, state)
+        self.assertEqual(pickle.loads(pickle.dumps(state, 2)), state)
+
+        other = Puzzle(2)
+        other.restore_state(state)
+        self.assertEqual(other.to_line(), puzzle.to_line())
+        self.assertEqual(other.save_state(), state)
+
+
+class TestPuzzlePool(unittest.TestCase):
+    def test_reset(self):
+        puzzle = Puzzle.prototype(2)
+        empty = puzzle.save_state()
+        puzzle.load_from_line('1...' '..2.' '....' '...4')
+        CandidateLines.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        puzzle.reset()
+        self.assertEqual(puzzle.save_state(), empty)
+        self.assertEqual(puzzle.strategies, [UniqueConstraints])
+        self.assertEqual(puzzle.solution_steps, [])
+
+    def test_shared_pools_are_bounded(self):
+        import gc
+        for offset in range(1, 20):
+            symbols = SYMBOLS[offset:offset + 4]
+            pool = PuzzlePool.shared(2, symbols)
+            self.assertIs(PuzzlePool.shared(2, symbols), pool)
+            pool.put(pool.get())
+        self.assertEqual(len(PuzzlePool._shared), PuzzlePool.shared_maxsize)
+        self.assertFalse((2, SYMBOLS[1:5]) in PuzzlePool._shared)
+        gc.collect()
+        self.assertFalse(tuple(SYMBOLS[1:5]) in Alphabet._alphabets)
+
+    def test_reused_puzzles_match_new_ones(self):
+        pool = PuzzlePool(2)
+        lines = ['1234............', '.234' '3.12' '2.4.' '4..1',
+                 '11..............', '1231............',
+                 '2......4.4....2.', '12..', 'xx']
+        for search in (False, True):
+            for line in lines + lines:
+                expected = solve_puzzle_text([line], 2, search=search)
+                puzzle, status, nodes = solve_puzzle_text(
+                    [line], 2, search=search, pool=pool)
+                self.assertEqual(status, expected[1])
+                if puzzle is not None:
+                    self.assertEqual(puzzle.to_line(), expected[0].to_line())
+                    pool.put(puzzle)
+        self.assertEqual(len(pool.free), 1)
+
+    def test_reused_puzzles_match_new_ones_for_states(self):
+        pool = PuzzlePool(2)
+        lines = ['1234............', '.234' '3.12' '2.4.' '4..1',
+                 '2......4.4....2.']
+        for search in (False, True):
+            for line in lines + lines:
+                loaded = Puzzle(2)
+                loaded.load_from_line(line)
+                state = loaded.save_state()
+                expected = solve_puzzle_state(state, search=search)
+                puzzle, status, nodes = solve_puzzle_state(
+                    state, search=search, pool=pool)
+                self.assertEqual(status, expected[1])
+                self.assertEqual(puzzle.to_line(), expected[0].to_line())
+                pool.put(puzzle)
+        self.assertEqual(len(pool.free), 1)
+
+
 class TestLoadAndParse(unittest.TestCase):
     def test_load_errors(self):
         puzzle = Puzzle(2)
@@ -178,6 +488,53 @@ class TestLoadAndParse(unittest.TestCase):
                     .. ..
                 """)
 
+    def test_load_from_line(self):
+        puzzle = Puzzle(2)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_line('12-0' + '.' * 12 + '\n')
+        self.assertEqual(puzzle.to_line(), '12..' + '.' * 12)
+        puzzle.load_from_line('..3.' + '.' * 12)
+        self.assertEqual(puzzle.to_line(), '1234' + '.' * 12)
+
+    def test_load_from_line_box_width_4(self):
+        puzzle = Puzzle(4)
+        line = '123456789ABCDEFG' + '.' * 240
+        puzzle.load_from_line(line)
+        self.assertEqual(puzzle.get_cell(0, 9).value, 'A')
+        self.assertEqual(puzzle.get_cell(0, 15).value, 'G')
+        self.assertEqual(puzzle.to_line(), line)
+
+    def test_symbols(self):
+        puzzle = Puzzle(2, symbols='abcd')
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_string("""
+            ab ..
+            .. a.
+            .. ..
+            .. .d
+            """)
+        self.assertEqual(puzzle.to_line(), 'abdc..ab...a...d')
+        self.assertEqual(puzzle.get_cell(1, 0).candidate_set, ['c', 'd'])
+        self.assertEqual(puzzle.copy().symbols, 'abcd')
+        for symbols in ('abc', 'abca', 'ab.d', 'ab d'):
+            self.assertRaises(ValueError, Puzzle, 2, symbols)
+
+    def test_large_grid_names(self):
+        puzzle = Puzzle(4)
+        self.assertEqual(len(set(cell.name for cell in puzzle.cells)), 256)
+        self.assertEqual(puzzle.get_cell(1, 11).name, 'C1,11')
+        self.assertEqual(puzzle.boxes[-1].name, 'Box12,12')
+
+    def test_load_from_line_errors(self):
+        puzzle = Puzzle(2)
+        self.assertRaisesRegexp(PuzzleParseError, 'expected 16 characters',
+                                puzzle.load_from_line, '12')
+        self.assertRaisesRegexp(PuzzleParseError, 'invalid character "5"',
+                                puzzle.load_from_line, '5' + '.' * 15)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        self.assertRaises(Contradiction,
+                          puzzle.load_from_line, '11' + '.' * 14)
+
     def test_load_candidates_unexpected_number_of_words(self):
         puzzle = Puzzle(2)
         self.assertRaisesRegexp(PuzzleParseError,
@@ -559,6 +916,584 @@ class TestSolvers(unittest.TestCase):
         finally:
             logging.getLogger().setLevel(logging.CRITICAL)
 
+
+class TestTrail(unittest.TestCase):
+    def make_puzzle(self):
+        puzzle = Puzzle(3)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_file('hard.txt')
+        CandidateLines.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        return puzzle
+
+    def normalise(self, obj):
+        if isinstance(obj, dict):
+            return sorted((repr(k), self.normalise(v)) for k, v in obj.items())
+        if isinstance(obj, (set, list)):
+            return sorted(self.normalise(x) for x in obj)
+        return repr(obj)
+
+    def strategy_state(self, puzzle):
+        state = []
+        for cell in puzzle.cells:
+            for lsnr in cell.cell_value_set_listeners:
+                if isinstance(lsnr, UniqueConstraints):
+                    state.append(lsnr.cells)
+                elif isinstance(lsnr, SinglePosition):
+                    state.append(lsnr.possible_cells_by_value)
+                elif isinstance(lsnr, CountingSinglePosition):
+                    state.append((lsnr.counts, lsnr.xors, lsnr.counted))
+                else:
+                    state.append((lsnr.positions, lsnr.rows, lsnr.cols))
+        return self.normalise(state)
+
+    def test_undo_to(self):
+        puzzle = Puzzle(3)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        CandidateLines.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        before = self.strategy_state(puzzle)
+        mark = puzzle.mark()
+        self.assertEqual(mark, 0)
+        puzzle.load_from_file('hard.txt')
+        self.assertTrue(puzzle.is_solved())
+        self.assertTrue(len(puzzle.trail) > 0)
+
+        puzzle.undo_to(mark)
+        self.assertEqual(puzzle.to_line(), '.' * 81)
+        self.assertTrue(puzzle.is_equal_to(Puzzle(3)))
+        self.assertEqual(puzzle.solution_steps, [])
+        self.assertEqual(self.strategy_state(puzzle), before)
+
+        puzzle.load_from_file('hard.txt')
+        self.assertEqual(puzzle.to_line(), self.make_puzzle().to_line())
+
+    def test_undo_counting_single_position(self):
+        puzzle = Puzzle(3)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        CountingSinglePosition.add_to_puzzle(puzzle)
+        before = self.strategy_state(puzzle)
+        mark = puzzle.mark()
+        puzzle.load_from_file('hard.txt')
+        puzzle.undo_to(mark)
+        self.assertTrue(puzzle.is_equal_to(Puzzle(3)))
+        self.assertEqual(self.strategy_state(puzzle), before)
+
+    def test_nested_marks(self):
+        puzzle = Puzzle(2)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        first = puzzle.mark()
+        puzzle.get_cell(0, 0).set_value('1')
+        after_first = puzzle.to_string()
+        second = puzzle.mark()
+        puzzle.get_cell(1, 2).set_value('1')
+        puzzle.undo_to(second)
+        self.assertEqual(puzzle.to_string(), after_first)
+        puzzle.undo_to(first)
+        self.assertTrue(puzzle.is_equal_to(Puzzle(2)))
+
+
+class TestSearch(unittest.TestCase):
+    def make_puzzle(self, text, box_width=2):
+        puzzle = Puzzle(box_width)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_string(text)
+        CandidateLines.add_to_puzzle(puzzle)
+        SinglePosition.add_to_puzzle(puzzle)
+        return puzzle
+
+    def test_search_empty_puzzle(self):
+        puzzle = self.make_puzzle("")
+        self.assertFalse(puzzle.is_solved())
+        search = Search()
+        solution = search.solve(puzzle)
+        self.assertTrue(solution is puzzle)
+        self.assertTrue(puzzle.is_solved())
+        self.assertTrue(search.nodes > 1)
+
+    def test_search_no_solution(self):
+        # Row 0 has nowhere to put a 4.
+        puzzle = self.make_puzzle(
+            """
+            2. ..
+            .. .4
+
+            .4 ..
+            .. 2.
+            """)
+        self.assertFalse(puzzle.is_solved())
+        before = puzzle.to_string()
+        self.assertTrue(Search().solve(puzzle) is None)
+        self.assertEqual(puzzle.to_string(), before)
+
+    def test_repeated_value_is_contradiction(self):
+        cells = [Cell([1, 2, 3], row=0, col=col) for col in range(3)]
+        group = UniqueConstraints(CellGroup(cells))
+        cells[0].set_value(1)
+        self.assertRaises(Contradiction, group.on_value_set, cells[1], 1)
+
+    def test_search_timeout(self):
+        puzzle = self.make_puzzle("", box_width=3)
+        self.assertRaises(SearchTimeout,
+                          Search(time_limit=-1).solve, puzzle)
+
+    def test_count_solutions(self):
+        puzzle = self.make_puzzle("")
+        before = puzzle.to_string()
+        self.assertEqual(puzzle.count_solutions(limit=None), 288)
+        self.assertEqual(puzzle.count_solutions(), 2)
+        self.assertEqual(puzzle.to_string(), before)
+
+        puzzle = self.make_puzzle(
+            """
+            2. ..
+            .. .4
+
+            .4 ..
+            .. 2.
+            """)
+        self.assertEqual(puzzle.count_solutions(), 0)
+
+        puzzle = self.make_puzzle(open('evil.txt').read(), box_width=3)
+        self.assertEqual(puzzle.count_solutions(), 1)
+        self.assertFalse(puzzle.is_solved())
+
+
+class TestDancingLinks(unittest.TestCase):
+    def make_puzzle(self, line, box_width=2):
+        puzzle = Puzzle(box_width)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        if line:
+            puzzle.load_from_line(line)
+        return puzzle
+
+    def test_all_solutions(self):
+        # 288 is the number of 4x4 grids
+        puzzle = self.make_puzzle(None)
+        solutions = list(DancingLinks().solutions(puzzle))
+        self.assertEqual(len(solutions), 288)
+        self.assertEqual(len(set(map(tuple, solutions))), 288)
+        self.assertEqual(
+            len(list(DancingLinks().solutions(puzzle, limit=5))), 5)
+
+    def test_respects_candidates(self):
+        puzzle = self.make_puzzle('1...' '....' '....' '....')
+        puzzle.get_cell(1, 2).remove_candidate('2')
+        for solution in DancingLinks().solutions(puzzle):
+            self.assertEqual(solution[0], '1')
+            self.assertNotEqual(solution[6], '2')
+
+    def test_no_solution(self):
+        puzzle = self.make_puzzle('2......4.4....2.')
+        before = puzzle.to_line()
+        self.assertTrue(DancingLinks().solve(puzzle) is None)
+        self.assertEqual(puzzle.to_line(), before)
+
+    def test_solve(self):
+        for box_width in (3, 4):
+            puzzle = self.make_puzzle(None, box_width)
+            self.assertTrue(DancingLinks().solve(puzzle) is puzzle)
+            self.assertTrue(puzzle.is_solved())
+
+    def test_solve_puzzle_text(self):
+        with open('evil.txt') as source:
+            lines = list(source)
+        puzzle, status, nodes = solve_puzzle_text(lines, search='dlx')
+        self.assertEqual(status, 'solved')
+        solution, status, nodes = solve_puzzle_text(lines, search=True)
+        self.assertEqual(puzzle.to_line(), solution.to_line())
+
+
+def solve_batch_results(puzzles, **kwargs):
+    """
+    Run solve_batch() on 4x4 puzzles, with search unless given.  Returns
+    the output grids, the status lines without their timings, and the
+    metrics counted during the run.
+    """
+    from StringIO import StringIO
+    out = StringIO()
+    kwargs.setdefault('search', True)
+    saved, metrics.metrics = metrics.metrics, {}
+    try:
+        solve_batch(puzzles, out, box_width=2, **kwargs)
+        counts = metrics.metrics
+    finally:
+        metrics.metrics = saved
+    lines = out.getvalue().splitlines()
+    statuses = [line.split(" in ")[0] for line in lines[1::2]]
+    return lines[0::2], statuses, counts
+
+
+class TestBatch(unittest.TestCase):
+    def test_iter_puzzle_texts(self):
+        texts = list(iter_puzzle_texts(dedent(
+            """\
+            # comment
+            12.......34.....
+
+            12 ..
+            .. 34
+
+            .. ..
+            .. ..
+            """).splitlines(), box_width=2))
+        self.assertEqual(texts, [
+            ['12.......34.....'],
+            ['12 ..', '.. 34', '.. ..', '.. ..'],
+        ])
+
+    def test_iter_truncated_puzzle_texts(self):
+        texts = list(iter_puzzle_texts(dedent(
+            """\
+            12 ..
+            .. 34
+            12.......34.....
+            .. .. ..
+            12.......34.....
+            """).splitlines(), box_width=2))
+        self.assertEqual(texts, [
+            ['12 ..', '.. 34'],
+            ['12.......34.....'],
+            ['.. .. ..'],
+            ['12.......34.....'],
+        ])
+        statuses = [solve_puzzle_text(text, 2)[1] for text in texts]
+        self.assertEqual(statuses, ['invalid', 'solved', 'invalid', 'solved'])
+
+    def test_solve_batch(self):
+        from StringIO import StringIO
+        out = StringIO()
+        solve_batch(
+            ['1234............', '.' * 16, '2......4.4....2.'], out,
+            box_width=2, search=True)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(len(lines[0]), 16)
+        self.assertTrue(lines[0].startswith('1234'))
+        self.assertTrue(lines[1].startswith('# puzzle 1: solved'))
+        self.assertTrue(lines[3].startswith('# puzzle 2: solved'))
+        self.assertTrue(lines[5].startswith('# puzzle 3: no_solution'))
+
+    def test_solve_batch_jobs(self):
+        puzzles = ['1234............', '.' * 16, '2......4.4....2.'] * 3
+        serial = solve_batch_results(puzzles)
+        self.assertEqual(solve_batch_results(puzzles, jobs=2, chunksize=2),
+                         serial)
+        grids, statuses, counts = solve_batch_results(
+            puzzles, jobs=2, chunksize=1, ordered=False)
+        self.assertEqual(sorted(statuses), sorted(serial[1]))
+        self.assertEqual(counts, serial[2])
+
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+@unittest.skipIf(numpy is None, 'needs NumPy')
+class TestSinglesBatch(unittest.TestCase):
+    def test_propagate(self):
+        engine = SinglesBatch(2)
+        masks, valid = engine.parse([
+            '1...' '..2.' '....' '...4',    # needs search
+            '12..' '34..' '....' '....',    # not solved by singles
+            '2......4.4....2.',             # no solution
+            '1.3.' '..2.' '.1..' '4..1',    # 1 repeated in col 0
+            '1...' '..2.' '....' '...z',    # invalid
+            '.234' '3.12' '2.4.' '4..1',    # singles
+        ])
+        self.assertEqual(list(valid), [True] * 4 + [False, True])
+        dead = engine.propagate(masks)
+        self.assertEqual(list(dead), [False, False, True, True, True, False])
+        self.assertEqual(list(engine.is_solved(masks)),
+                         [False, False, False, False, False, True])
+        self.assertEqual(engine.to_lines(masks)[5], '1234341221434321')
+
+        state = engine.to_state(masks[1])
+        self.assertEqual(state.get_value(0, 1), '2')
+        self.assertEqual(state.get_candidates(0, 2), ['3', '4'])
+        puzzle, status, nodes = solve_puzzle_state(state, search=True)
+        self.assertEqual(status, 'solved')
+
+    def test_solve_batch(self):
+        puzzles = [
+            '1234............',             # unfinished by singles
+            '.234' '3.12' '2.4.' '4..1',    # singles
+            '2......4.4....2.',             # no solution, needs search
+            '1.3.' '..2.' '.1..' '4..1',    # no solution by singles
+            '1...' '..2.' '....' '...z',    # invalid
+            '12 ..', '.. 34', '.. ..', '.. ..',
+        ]
+        kinds = {}
+        for search in (False, True):
+            expected = solve_batch_results(puzzles, search=search)
+            grids, statuses, counts = solve_batch_results(
+                puzzles, search=search, vectorize=True, chunksize=3)
+            self.assertEqual((grids, statuses), expected[:2])
+            kinds[search] = [status.split()[-1] for status in statuses]
+        self.assertEqual(kinds[False], [
+            'unsolved', 'solved', 'unsolved', 'no_solution', 'invalid',
+            'no_solution'])
+        self.assertEqual(kinds[True][:3], ['solved', 'solved', 'no_solution'])
+
+    def test_solve_batch_cache(self):
+        # needs search, so reaches the cache; the second is transposed
+        puzzles = ['1...' '..2.' '....' '...4', '1...' '....' '.2..' '...4']
+        grids, statuses, counts = solve_batch_results(
+            puzzles, vectorize=True, cache=SolutionCache())
+        self.assertEqual(counts.get('SolutionCache.miss'), 1)
+        self.assertEqual(counts.get('SolutionCache.hit'), 1)
+        self.assertTrue(statuses[1].startswith('# puzzle 2: solved'))
+        self.assertEqual(grids[1][0] + grids[1][9] + grids[1][15], '124')
+
+
+class TestSolutionCache(unittest.TestCase):
+    def setUp(self):
+        import random
+        import bench
+        self.rng = random.Random(1)
+        self.transform = bench.transform_puzzle
+        with open('hard.txt') as source:
+            puzzle, status, nodes = solve_puzzle_text(list(source))
+        self.line = bench.load_tier('hard')[0]
+        self.solution = puzzle.to_line()
+
+    def test_canonical_form(self):
+        canonical, transform = canonical_form(self.line)
+        self.assertEqual(transform.apply(self.line), canonical)
+        self.assertEqual(transform.invert(canonical), self.line)
+        for i in range(5):
+            variant = self.transform(self.line, self.rng)
+            self.assertEqual(canonical_form(variant)[0], canonical)
+        self.assertEqual(canonical_form('.' * 81), (None, None))
+
+    def test_get_and_put(self):
+        cache = SolutionCache(maxsize=1)
+        self.assertEqual(cache.get(self.line), None)
+        cache.put(self.line, self.solution)
+        self.assertEqual(cache.get(self.line), self.solution)
+
+        variant = self.transform(self.line, self.rng)
+        solution = cache.get(variant)
+        puzzle = Puzzle(3)
+        UniqueConstraints.add_to_puzzle(puzzle)
+        puzzle.load_from_line(solution)
+        self.assertTrue(puzzle.is_solved())
+        for given, value in zip(variant, solution):
+            self.assertTrue(given == '.' or given == value)
+
+        cache.put('.' * 81, self.solution)      # too symmetric, so exact
+        self.assertEqual(cache.get('.' * 81), self.solution)
+        self.assertEqual(cache.get(self.line), None)    # evicted
+
+    def test_file(self):
+        import shutil
+        import tempfile
+        directory = tempfile.mkdtemp()
+        try:
+            path = directory + "/cache"
+            cache = SolutionCache(path=path)
+            cache.put(self.line, self.solution)
+            cache.close()
+            cache = SolutionCache(path=path)
+            self.assertEqual(cache.get(self.line), self.solution)
+            cache.close()
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestResultStore(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.directory = tempfile.mkdtemp()
+        self.path = self.directory + '/results.db'
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.directory)
+
+    def test_lookup_and_insert(self):
+        store = ResultStore(self.path)
+        store.insert([('1...', '1234', 'solved', {'Guess': 1}),
+                      ('2...', '2...', 'no_solution', {})], box_width=1)
+        self.assertEqual(store.lookup(['1...', '3...'], box_width=1),
+                         {'1...': ('1234', 'solved', {'Guess': 1})})
+        self.assertEqual(store.lookup(['1...']), {})
+        store.close()
+        self.assertEqual(len(ResultStore(self.path)), 2)
+
+    def test_solve_batch(self):
+        puzzles = ['1234............', '.234' '3.12' '2.4.' '4..1',
+                   '2......4.4....2.', '12 ..', '.. 34', '.. ..', '.. ..']
+
+        def results(**kwargs):
+            grids, statuses, counts = solve_batch_results(
+                puzzles, store=self.path, chunksize=2, **kwargs)
+            return grids, statuses, counts.get('ResultStore.hit', 0)
+
+        grids, statuses, hits = results()
+        self.assertEqual(hits, 0)
+        self.assertEqual(results(jobs=2), (grids, statuses, 3))
+        self.assertEqual(
+            ResultStore(self.path).lookup(['1234............'], 2)[
+                '1234............'][1], 'solved')
+
+
+class TestServer(unittest.TestCase):
+    def test_pipelined_requests(self):
+        import json
+        import socket
+        import threading
+        server = make_server('127.0.0.1:0', jobs=2, max_pending=2,
+                             box_widths=(2,))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            connection = socket.create_connection(server.server_address)
+            requests = [
+                {'id': 1, 'puzzle': '1234............', 'box_width': 2},
+                {'id': 2, 'puzzle': ['12 ..', '.. ..', '.. ..', '.. ..'],
+                 'box_width': 2, 'search': 'dlx',
+                 'strategies': ['SinglePosition']},
+                {'id': 3, 'puzzle': '11..............', 'box_width': 2},
+                {'id': 4, 'puzzle': '1234', 'strategies': ['Magic']},
+            ]
+            connection.sendall(''.join(
+                json.dumps(request) + '\n' for request in requests))
+            connection.shutdown(socket.SHUT_WR)
+            responses = [json.loads(line)
+                         for line in connection.makefile().readlines()]
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual([r['id'] for r in responses], [1, 2, 3, 4])
+        self.assertEqual(responses[0]['status'], 'solved')
+        self.assertEqual(responses[0]['solution'][:4], '1234')
+        self.assertEqual(responses[1]['status'], 'solved')
+        self.assertEqual(responses[2]['status'], 'no_solution')
+        self.assertIn('Magic', responses[3]['error'])
+
+    def test_stalled_client(self):
+        import json
+        import os
+        import shutil
+        import socket
+        import tempfile
+        import threading
+        directory = tempfile.mkdtemp()
+        server = make_server(os.path.join(directory, 'socket'), jobs=2,
+                             max_pending=4, box_widths=(2,))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        request = json.dumps(
+            {'puzzle': '1234............', 'box_width': 2}) + '\n'
+        stalled = socket.socket(socket.AF_UNIX)
+        stalled.connect(server.server_address)
+        # sends until the server stops reading; never reads a response
+        sender = threading.Thread(target=stalled.sendall,
+                                  args=(request * 20000,))
+        sender.daemon = True
+        sender.start()
+        try:
+            sender.join(2)
+            self.assertTrue(sender.is_alive())  # no longer read from
+            client = socket.socket(socket.AF_UNIX)
+            client.settimeout(10)
+            client.connect(server.server_address)
+            client.sendall(request)
+            response = json.loads(client.makefile().readline())
+            client.close()
+        finally:
+            stalled.close()
+            server.shutdown()
+            server.server_close()
+            shutil.rmtree(directory)
+        self.assertEqual(response['status'], 'solved')
+
+    def test_bad_requests_keep_the_pool(self):
+        import sud2
+        pool = PuzzlePool.shared(2)
+        line = '1234' + '.' * 12
+        good = sud2._serve_request({'id': 1, 'puzzle': line, 'box_width': 2})
+        self.assertEqual(good['status'], 'solved')
+        free = len(pool.free)
+        for request in [{'time_limit': 'abc'}, {'time_limit': True},
+                        {'box_width': 0}, {'search': 'magic'},
+                        {'box_width': 14}, {'symbols': '12'},
+                        {'box_width': 8, 'symbols': '1' * 64}]:
+            request.update(id=2, puzzle=line)
+            request.setdefault('box_width', 2)
+            self.assertIn('error', sud2._serve_request(request))
+        self.assertEqual(len(pool.free), free)
+        self.assertFalse(set([8, 14]) & set(Topology._topologies))
+        self.assertRaises(ValueError, Puzzle, 14)
+        self.assertFalse(14 in Topology._topologies)
+        self.assertEqual(sud2._serve_request(
+            {'puzzle': line, 'box_width': 2}, 0.5)['status'], 'solved')
+
+    def test_time_limit_is_capped(self):
+        import sud2
+        line = '.' * 25 ** 2        # too slow to backtrack
+        for time_limit in (None, 0, -1, 60):
+            request = {'puzzle': line, 'box_width': 5,
+                       'time_limit': time_limit}
+            response = sud2._serve_request(request, 0.2)
+            self.assertEqual(response['status'], 'timeout')
+            self.assertTrue(response['elapsed_ms'] < 5000)
+
+
+class TestBench(unittest.TestCase):
+    def test_transform_puzzle(self):
+        import random
+        import bench
+        line = bench.load_tier('hard')[0]
+        rng = random.Random(1)
+        for i in range(5):
+            variant = bench.transform_puzzle(line, rng)
+            self.assertEqual(variant.count('.'), line.count('.'))
+            puzzle, status, nodes = solve_puzzle_text([variant], search=True)
+            self.assertEqual(status, 'solved')
+
+    def test_make_grid_corpus(self):
+        import bench
+        for line in bench.make_grid_corpus(4, 2, seed=0):
+            self.assertEqual(len(line), 256)
+            self.assertTrue(bench.solve_sud2(line, box_width=4))
+
+    def test_measure_memory(self):
+        import bench
+        stats = bench.run_isolated(bench.measure_memory, 2, 5, 0)
+        self.assertEqual(stats['puzzles'], 5)
+        self.assertFalse(hasattr(Puzzle(2).get_cell(0, 0), '__dict__'))
+
+
+class TestGenerate(unittest.TestCase):
+    def test_generate(self):
+        import generate
+        puzzles = list(generate.generate(3, 'medium', seed=1, count=2))
+        self.assertEqual(len(puzzles), 2)
+        for line in puzzles:
+            self.assertEqual(generate.grade(line), 'medium')
+            self.assertTrue(generate.is_unique(line, 3))
+        self.assertEqual(
+            list(generate.generate(3, 'medium', seed=1, count=2, jobs=2)),
+            puzzles)
+
+    def test_hard(self):
+        import generate
+        line, = generate.generate(3, 'hard', seed=2, count=1)
+        self.assertEqual(generate.grade(line), 'hard')
+        self.assertTrue(generate.is_unique(line, 3))
+        puzzle, status, nodes = solve_puzzle_text([line], search=True)
+        self.assertEqual(status, 'solved')
+        self.assertTrue(nodes > 1)
+
+
 init_logging()
 
 if __name__ == '__main__':